@@ -1,14 +1,42 @@
+import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, status, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from models import PredictionResponse
 from inference import (
     get_image_from_bytes,
     is_model_ready,
     run_inference,
+    warm_up,
 )
+from executor import BoundedExecutor
+from readiness import Readiness
 from logger import logger
 
-app = FastAPI()
+# YOLO models are not safe to call from several threads at once, so inference
+# runs on one worker by default; at most MAX_PENDING more requests wait for
+# it, the rest get 503
+INFERENCE_WORKERS = int(os.getenv("COIN_INFERENCE_WORKERS", "1"))
+MAX_PENDING = int(os.getenv("COIN_MAX_PENDING", "4"))
+RETRY_AFTER_S = int(os.getenv("COIN_RETRY_AFTER_S", "2"))
+
+# Run synthetic images through YOLO at startup, before reporting ready
+WARMUP = os.getenv("COIN_WARMUP", "true").lower() == "true"
+
+inference_executor = BoundedExecutor(INFERENCE_WORKERS, MAX_PENDING, RETRY_AFTER_S)
+
+readiness = Readiness(RETRY_AFTER_S)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm up in the background so that liveness is reported meanwhile
+    readiness.start(warm_up if WARMUP else dict)
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = ["*"]
 methods = ["*"]
@@ -23,6 +51,7 @@ app.add_middleware(
 )
 
 
+# Liveness: the process is up and the model loaded
 @app.get("/", status_code=status.HTTP_200_OK)
 def health_check():
     if not is_model_ready():
@@ -30,14 +59,31 @@ def health_check():
     return {"status": "healthy"}
 
 
+# Readiness: the model is warmed up
+@app.get("/ready", status_code=status.HTTP_200_OK)
+def ready():
+    if not readiness.is_ready:
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content=readiness.status(),
+        )
+    return readiness.status()
+
+
+def detect(image_bytes: bytes) -> PredictionResponse:
+    input_image, scale = get_image_from_bytes(image_bytes)
+    return run_inference(input_image, scale)
+
+
 @app.post("/predict", response_model=PredictionResponse)
 async def predict(image: UploadFile):
+    readiness.check()
+
     try:
         # Read image bytes from the uploaded file
         image_bytes = await image.read()
-        input_image = get_image_from_bytes(image_bytes)
 
-        predictions = run_inference(input_image)
+        predictions = await inference_executor.run(detect, image_bytes)
         logger.info(f"Predictions: {predictions}")
         return predictions
 
@@ -0,0 +1,102 @@
+import io
+import math
+from typing import NamedTuple
+
+import numpy as np
+from PIL import Image
+
+# Scales libjpeg can decode to directly, in the DCT domain
+DCT_REDUCTIONS = (1, 2, 4, 8)
+
+
+def dct_reduction(factor: float) -> int:
+    """
+    Largest DCT reduction that does not shrink the image by more than `factor`.
+    """
+    return max(r for r in DCT_REDUCTIONS if r <= max(factor, 1))
+
+
+def image_size(image_bytes: bytes) -> tuple[int, int] | None:
+    """
+    Reads (width, height) from the image header without decoding the pixels.
+    """
+    try:
+        return Image.open(io.BytesIO(image_bytes)).size
+    except Exception:
+        return None
+
+
+def decode_pil(
+    image_bytes: bytes, reduce: int = 1, greyscale: bool = False
+) -> tuple[Image.Image, float]:
+    """
+    Decodes image bytes to a PIL Image. JPEGs are decoded straight to up to
+    1/reduce of their size (and straight to greyscale) by libjpeg; other
+    formats are decoded at full size.
+    Returns the image and its scale (decoded px per original px).
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    original_width = image.width
+    mode = "L" if greyscale else "RGB"
+
+    if reduce > 1 and image.format == "JPEG":
+        image.draft(
+            mode,
+            (math.ceil(image.width / reduce), math.ceil(image.height / reduce)),
+        )
+
+    image = image.convert(mode)
+    return image, image.width / original_width
+
+
+class DecodeSettings(NamedTuple):
+    """
+    How a service decodes uploads with decode_pil: in greyscale or not, and
+    how far JPEGs may be shrunk in the DCT domain. That is either a fixed
+    `pixels_per_input` original px per model input px or, for images
+    resampled to a fixed ground resolution, `mm_per_input` mm per model
+    input px, so that it follows each upload's own mm per pixel.
+    """
+
+    greyscale: bool = False
+    pixels_per_input: float = 1.0
+    mm_per_input: float | None = None
+
+    def reduction(self, mm_per_pixel: float | None = None) -> int:
+        if self.mm_per_input and mm_per_pixel:
+            return dct_reduction(self.mm_per_input / mm_per_pixel)
+        return dct_reduction(self.pixels_per_input)
+
+    def decode(
+        self, image_bytes: bytes, mm_per_pixel: float | None = None
+    ) -> tuple[Image.Image, float]:
+        return decode_pil(
+            image_bytes, reduce=self.reduction(mm_per_pixel), greyscale=self.greyscale
+        )
+
+
+def decode_cv2(
+    image_bytes: bytes, reduce: int = 1, greyscale: bool = False
+) -> tuple[np.ndarray, float]:
+    """
+    Decodes image bytes to a cv2 (BGR or greyscale) image at 1/reduce of its
+    size, using libjpeg DCT scaling for JPEGs.
+    Returns the image and its scale (decoded px per original px).
+    """
+    import cv2
+
+    flags = {
+        (1, False): cv2.IMREAD_COLOR,
+        (2, False): cv2.IMREAD_REDUCED_COLOR_2,
+        (4, False): cv2.IMREAD_REDUCED_COLOR_4,
+        (8, False): cv2.IMREAD_REDUCED_COLOR_8,
+        (1, True): cv2.IMREAD_GRAYSCALE,
+        (2, True): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+        (4, True): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+        (8, True): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    }
+
+    image_array = np.frombuffer(image_bytes, dtype=np.uint8)
+    image = cv2.imdecode(image_array, flags[(reduce, greyscale)])
+
+    return image, 1 / reduce
@@ -0,0 +1,61 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import HTTPException, status
+
+
+class BoundedExecutor:
+    """
+    Runs blocking calls on a pool of `workers` threads, off the event loop.
+    At most `max_pending` calls may wait behind the busy workers; further
+    calls are rejected at once with 503 and a Retry-After header, so callers
+    can go to another replica instead of timing out.
+    """
+
+    def __init__(self, workers: int, max_pending: int, retry_after_s: int):
+        self.workers = workers
+        self.capacity = workers + max_pending
+        self.retry_after_s = retry_after_s
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="inference"
+        )
+        # Only touched from the event loop thread
+        self._in_flight = 0
+        self.rejected = 0
+
+    async def run(self, fn, *args, **kwargs):
+        if self._in_flight >= self.capacity:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server busy, retry later",
+                headers={"Retry-After": str(self.retry_after_s)},
+            )
+
+        loop = asyncio.get_running_loop()
+        future = self._pool.submit(functools.partial(fn, *args, **kwargs))
+        self._in_flight += 1
+        # The slot is freed once the call has finished, or was cancelled
+        # before it started because the client went away, not as soon as
+        # the caller stops waiting
+        future.add_done_callback(lambda _: self._release(loop))
+        return await asyncio.wrap_future(future)
+
+    def _release(self, loop: asyncio.AbstractEventLoop):
+        try:
+            loop.call_soon_threadsafe(self._done)
+        except RuntimeError:
+            # The event loop has already shut down
+            pass
+
+    def _done(self):
+        self._in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "capacity": self.capacity,
+            "in_flight": self._in_flight,
+            "rejected": self.rejected,
+        }
@@ -1,8 +1,11 @@
 from fastapi import HTTPException
 from models import PredictionResponse
 from ultralytics import YOLO
+from decode import dct_reduction, decode_cv2, image_size
 import cv2
 import numpy as np
+import os
+import time
 from logger import logger
 
 # Model initialization and readiness state
@@ -35,12 +38,43 @@ def is_model_ready() -> bool:
     return _model_ready and model_yolo is not None
 
 
-def get_image_from_bytes(image_bytes: bytes):
-    """Convert image from bytes to cv2 image"""
-    image_array = np.frombuffer(image_bytes, dtype=np.uint8)
-    image = cv2.imdecode(image_array, cv2.IMREAD_COLOR)
+# Images are decoded at the largest JPEG DCT reduction that keeps their
+# longest side at least this many pixels
+DECODE_MIN_SIDE = int(os.getenv("COIN_DECODE_MIN_SIDE", "1280"))
 
-    return image
+
+def get_image_from_bytes(image_bytes: bytes) -> tuple[np.ndarray, float]:
+    """Convert image from bytes to a reduced resolution cv2 image.
+    Returns the image and its scale (decoded px per original px)."""
+    size = image_size(image_bytes)
+    reduce = dct_reduction(max(size) / DECODE_MIN_SIDE) if size else 1
+
+    return decode_cv2(image_bytes, reduce)
+
+
+def warm_up() -> dict:
+    """Run YOLO on synthetic landscape and portrait images of the decoded
+    size, so that fusing and kernel selection happen before the first
+    request. Returns how long each run took, in seconds."""
+    if not is_model_ready():
+        raise RuntimeError("YOLO model failed to load")
+
+    rng = np.random.default_rng(0)
+    short_side = DECODE_MIN_SIDE * 3 // 4
+    timings = {}
+
+    for name, shape in (
+        ("landscape", (short_side, DECODE_MIN_SIDE, 3)),
+        ("portrait", (DECODE_MIN_SIDE, short_side, 3)),
+    ):
+        _, encoded = cv2.imencode(".jpg", rng.integers(0, 256, shape, dtype=np.uint8))
+
+        start = time.perf_counter()
+        image, _ = get_image_from_bytes(encoded.tobytes())
+        model_yolo(image, retina_masks=True, verbose=False)
+        timings[name] = round(time.perf_counter() - start, 3)
+
+    return timings
 
 
 COIN_DIAMETER_MM = 24.26
@@ -62,8 +96,10 @@ def segment(image):
     return points, classidx
 
 
-def run_inference(input_image):
-    """Run inference on an image using YOLO11n model."""
+def run_inference(input_image, scale: float = 1.0):
+    """Run inference on an image using YOLO11n model.
+    `scale` is the size of input_image relative to the original upload;
+    the returned geometry is in the original pixel frame."""
     global model_yolo
 
     # Check if model is ready
@@ -82,9 +118,11 @@ def run_inference(input_image):
 
         ellipse = cv2.fitEllipse(points)
 
-        (center, (width, height), angle) = ellipse
+        center, (width, height), angle = ellipse
 
-        diameter = (width + height) / 2.0
+        # Back to the original pixel frame
+        center = (center[0] / scale, center[1] / scale)
+        diameter = (width + height) / 2.0 / scale
 
         return PredictionResponse(
             mm_per_pixel=float(COIN_DIAMETER_MM / diameter),
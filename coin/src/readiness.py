@@ -0,0 +1,70 @@
+import threading
+import time
+from typing import Callable
+
+from fastapi import HTTPException, status
+
+from logger import logger
+
+
+class Readiness:
+    """
+    Runs the service's warm-up in the background and tracks whether it has
+    finished, so that liveness can be reported while the model warms up and
+    traffic is only accepted once it has. Once warmed up, `available` (if
+    given) is asked whether the service can take traffic right now, e.g.
+    while crashed inference workers restart.
+    """
+
+    def __init__(self, retry_after_s: int, available: Callable[[], bool] | None = None):
+        self.retry_after_s = retry_after_s
+        self.available = available
+        self.ready = False
+        self.error = None
+        self.timings = None
+        self.warmup_s = None
+        self._thread = None
+
+    def start(self, warm_up: Callable[[], dict]):
+        self._thread = threading.Thread(
+            target=self._run, args=(warm_up,), name="warm-up", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, warm_up: Callable[[], dict]):
+        logger.info("[*] Warming up...")
+        start = time.perf_counter()
+        try:
+            self.timings = warm_up()
+        except Exception as e:
+            logger.exception(f"Warm-up failed: {e}")
+            self.error = str(e)
+            return
+        self.warmup_s = round(time.perf_counter() - start, 3)
+        self.ready = True
+        logger.info(f"[*] Warm-up done in {self.warmup_s}s: {self.timings}")
+
+    @property
+    def is_ready(self) -> bool:
+        return self.ready and (self.available is None or self.available())
+
+    def check(self):
+        """
+        Raises 503 with a Retry-After header until the warm-up has finished,
+        and while the service is not available.
+        """
+        if not self.is_ready:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=self.error
+                or ("Warming up" if not self.ready else "Unavailable"),
+                headers={"Retry-After": str(self.retry_after_s)},
+            )
+
+    def status(self) -> dict:
+        return {
+            "ready": self.is_ready,
+            "error": self.error,
+            "warmup_s": self.warmup_s,
+            "timings": self.timings,
+        }
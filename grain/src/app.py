@@ -1,11 +1,81 @@
+from contextlib import asynccontextmanager
 from typing import Annotated
-from inference import run_inference
+import os
+from executor import BoundedExecutor
 from fastapi import FastAPI, Form, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from models import Coin, PredictionRequest, PredictionResponse
+from readiness import Readiness
 from logger import logger
 
-app = FastAPI()
+# Run inference in this many separate processes, each pinned to its own
+# share of the cores (0 = in this process)
+PROCESS_WORKERS = int(os.getenv("GRAIN_PROCESS_WORKERS", "0"))
+PIN_CORES = os.getenv("GRAIN_PIN_CORES", "true").lower() == "true"
+WORKER_START_TIMEOUT_S = float(os.getenv("GRAIN_WORKER_START_TIMEOUT_S", "300"))
+# A job a worker has not answered in this long fails with 504
+JOB_TIMEOUT_S = float(os.getenv("GRAIN_JOB_TIMEOUT_S", "120"))
+
+# Decode images here and hand them to the worker processes through shared
+# memory instead of sending the encoded bytes
+SHARED_IMAGES = os.getenv("GRAIN_SHARED_IMAGES", "true").lower() == "true"
+
+# Inference runs on a thread pool of this many workers; at most
+# MAX_PENDING more requests wait for a worker, the rest get 503
+INFERENCE_WORKERS = int(os.getenv("GRAIN_INFERENCE_WORKERS", str(PROCESS_WORKERS or 2)))
+MAX_PENDING = int(os.getenv("GRAIN_MAX_PENDING", "4"))
+RETRY_AFTER_S = int(os.getenv("GRAIN_RETRY_AFTER_S", "5"))
+
+if PROCESS_WORKERS > 0:
+    # The model is only loaded in the worker processes
+    from workers import WorkerPool
+
+    # Images are decoded on the executor threads, one block each
+    worker_pool = WorkerPool(
+        PROCESS_WORKERS,
+        pin_cores=PIN_CORES,
+        shared_images=SHARED_IMAGES,
+        max_images=INFERENCE_WORKERS,
+        retry_after_s=RETRY_AFTER_S,
+        job_timeout_s=JOB_TIMEOUT_S,
+    )
+    run_inference = worker_pool.run_inference
+else:
+    from inference import (
+        WARMUP,
+        batch_buffers,
+        micro_batcher,
+        result_cache,
+        run_inference,
+        tile_cache,
+        warm_up,
+    )
+
+    worker_pool = None
+
+inference_executor = BoundedExecutor(INFERENCE_WORKERS, MAX_PENDING, RETRY_AFTER_S)
+
+# With worker processes, the service is only ready while one of them is
+readiness = Readiness(
+    RETRY_AFTER_S, available=worker_pool.available if worker_pool else None
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm up in the background so that liveness is reported meanwhile
+    if worker_pool is not None:
+        # Every worker warms up before reporting ready
+        readiness.start(lambda: worker_pool.start(WORKER_START_TIMEOUT_S))
+    else:
+        readiness.start(warm_up if WARMUP else dict)
+    yield
+    if worker_pool is not None:
+        worker_pool.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = ["*"]
 methods = ["*"]
@@ -20,13 +90,46 @@ app.add_middleware(
 )
 
 
+# Liveness: the process is up and serving HTTP
 @app.get("/", status_code=status.HTTP_200_OK)
 def health_check():
     return {"status": "healthy"}
 
 
+# Readiness: the model is loaded and warmed up
+@app.get("/ready", status_code=status.HTTP_200_OK)
+def ready():
+    if not readiness.is_ready:
+        return JSONResponse(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            content=readiness.status(),
+        )
+    return readiness.status()
+
+
+@app.get("/stats", status_code=status.HTTP_200_OK)
+def stats():
+    if worker_pool is not None:
+        return {
+            **worker_pool.stats(),
+            "executor": inference_executor.stats(),
+            "readiness": readiness.status(),
+        }
+
+    return {
+        "result_cache": result_cache.stats(),
+        "tile_cache": tile_cache.stats(),
+        "micro_batcher": micro_batcher.stats() if micro_batcher else None,
+        "batch_buffers": batch_buffers.stats(),
+        "executor": inference_executor.stats(),
+        "readiness": readiness.status(),
+    }
+
+
 @app.post("/predict", response_model=PredictionResponse)
 async def predict(request: Annotated[PredictionRequest, Form()]):
+    readiness.check()
+
     try:
         image = request.image
         image_bytes = await image.read()
@@ -46,7 +149,9 @@ async def predict(request: Annotated[PredictionRequest, Form()]):
 
         mm_per_pixel = request.mm_per_pixel
 
-        predictions = run_inference(image_bytes, coin, mm_per_pixel)
+        predictions = await inference_executor.run(
+            run_inference, image_bytes, coin, mm_per_pixel, max_tiles=request.max_tiles
+        )
         logger.info(f"Predictions: {predictions}")
         return predictions
 
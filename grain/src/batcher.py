@@ -0,0 +1,153 @@
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from typing import Callable
+
+import numpy as np
+
+from logger import logger
+
+
+class _Pending:
+    __slots__ = ("tiles", "stats", "future", "enqueued")
+
+    def __init__(self, tiles: list[np.ndarray], stats: dict | None):
+        self.tiles = tiles
+        self.stats = stats
+        self.future: Future = Future()
+        self.enqueued = time.perf_counter()
+
+
+class MicroBatcher:
+    """
+    Dynamic batching across requests. Callers submit lists of at most
+    `max_batch_size` tiles and wait on a future; one inference thread
+    collects pending submissions as long as they fit in `max_batch_size`
+    tiles and the oldest one has waited less than `max_wait_s`, runs
+    `predict_fn` once on all their tiles and hands every caller its slice of
+    the output.
+    `predict_fn` is also given a stats dict of counters for the batch, which
+    are added to the stats of every submission in it, before its future is
+    resolved.
+    """
+
+    def __init__(
+        self,
+        predict_fn: Callable[..., np.ndarray],
+        max_batch_size: int,
+        max_wait_s: float,
+    ):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_s
+        self._queue: queue.Queue[_Pending] = queue.Queue()
+        # A submission that did not fit in the previous batch
+        self._carry: _Pending | None = None
+
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._tiles = 0
+        self._batch_sizes: Counter[int] = Counter()
+        self._wait_total_s = 0.0
+        self._wait_max_s = 0.0
+        self._submissions = 0
+
+        self._thread = threading.Thread(
+            target=self._loop, name="micro-batcher", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, tiles: list[np.ndarray], stats: dict | None = None) -> Future:
+        if len(tiles) > self.max_batch_size:
+            raise ValueError(
+                f"Submitted {len(tiles)} tiles, at most {self.max_batch_size} fit a batch"
+            )
+        pending = _Pending(tiles, stats)
+        self._queue.put(pending)
+        return pending.future
+
+    def predict(self, tiles: list[np.ndarray], stats: dict | None = None) -> np.ndarray:
+        return self.submit(tiles, stats).result()
+
+    def _collect(self) -> list[_Pending]:
+        first, self._carry = self._carry, None
+        if first is None:
+            first = self._queue.get()
+        batch = [first]
+        count = len(first.tiles)
+        deadline = first.enqueued + self.max_wait_s
+
+        while count < self.max_batch_size:
+            # Past the deadline, only take what is already queued
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    pending = self._queue.get(timeout=timeout)
+                else:
+                    pending = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if count + len(pending.tiles) > self.max_batch_size:
+                self._carry = pending
+                break
+            batch.append(pending)
+            count += len(pending.tiles)
+
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            self._record(batch, started)
+
+            batch_stats: dict[str, int] = {}
+            try:
+                tiles = [tile for pending in batch for tile in pending.tiles]
+                predictions = self.predict_fn(tiles, stats=batch_stats)
+            except Exception as e:
+                logger.error(f"Micro-batch of {len(batch)} requests failed: {e}")
+                for pending in batch:
+                    pending.future.set_exception(e)
+                continue
+
+            start = 0
+            for pending in batch:
+                if pending.stats is not None:
+                    for key, value in batch_stats.items():
+                        pending.stats[key] = pending.stats.get(key, 0) + value
+                end = start + len(pending.tiles)
+                pending.future.set_result(predictions[start:end])
+                start = end
+
+    def _record(self, batch: list[_Pending], started: float):
+        with self._lock:
+            size = sum(len(pending.tiles) for pending in batch)
+            self._batches += 1
+            self._tiles += size
+            self._batch_sizes[size] += 1
+            self._submissions += len(batch)
+            for pending in batch:
+                wait = started - pending.enqueued
+                self._wait_total_s += wait
+                self._wait_max_s = max(self._wait_max_s, wait)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "batches": self._batches,
+                "tiles": self._tiles,
+                "queued": self._queue.qsize() + (self._carry is not None),
+                "mean_batch_size": (
+                    self._tiles / self._batches if self._batches else 0.0
+                ),
+                "batch_sizes": dict(sorted(self._batch_sizes.items())),
+                "mean_queue_wait_ms": (
+                    1000 * self._wait_total_s / self._submissions
+                    if self._submissions
+                    else 0.0
+                ),
+                "max_queue_wait_ms": 1000 * self._wait_max_s,
+            }
@@ -0,0 +1,91 @@
+import threading
+
+import numpy as np
+
+# Buffers start on a cache line, as the runtimes' vectorized kernels prefer
+ALIGN = 64
+
+
+def aligned_zeros(shape: tuple[int, ...], dtype, align: int = ALIGN) -> np.ndarray:
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    raw = np.zeros(nbytes + align, dtype=np.uint8)
+    offset = -raw.ctypes.data % align
+    return raw[offset : offset + nbytes].view(dtype).reshape(shape)
+
+
+class BatchBuffer:
+    """
+    One batch worth of model input (`tiles`) and output (`predictions`).
+    """
+
+    __slots__ = ("tiles", "predictions")
+
+    def __init__(self, max_batch_size: int, tile_shape: tuple[int, ...], outputs: int):
+        self.tiles = aligned_zeros((max_batch_size, *tile_shape), np.uint8)
+        self.predictions = aligned_zeros((max_batch_size, outputs), np.float64)
+
+    @property
+    def nbytes(self) -> int:
+        return self.tiles.nbytes + self.predictions.nbytes
+
+
+class BatchBufferPool:
+    """
+    Preallocated, recycled batch buffers for the SediNet hot path, so that
+    tiles are written into an existing input array and predictions read out
+    of an existing output array instead of new ones being built per batch.
+    Only those two arrays are covered: the runtimes still copy the input into
+    their own tensors, and the bias correction has its own temporaries.
+    `max_buffers` are allocated up front, one per concurrent SediNet call;
+    when all of them are in use a one-off buffer is allocated and counted
+    as an overflow.
+    """
+
+    def __init__(
+        self,
+        max_buffers: int,
+        max_batch_size: int,
+        tile_shape: tuple[int, ...],
+        outputs: int,
+    ):
+        self.max_buffers = max_buffers
+        self.max_batch_size = max_batch_size
+        self.tile_shape = tile_shape
+        self.outputs = outputs
+
+        self._free = [self._new() for _ in range(max_buffers)]
+        self.buffer_bytes = self._free[0].nbytes if self._free else 0
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.overflows = 0
+
+    def _new(self) -> BatchBuffer:
+        return BatchBuffer(self.max_batch_size, self.tile_shape, self.outputs)
+
+    def acquire(self) -> tuple[BatchBuffer, bool]:
+        """
+        Returns a free buffer, and whether the pool overflowed and it had to
+        be allocated.
+        """
+        with self._lock:
+            self.acquired += 1
+            if self._free:
+                return self._free.pop(), False
+            self.overflows += 1
+        return self._new(), True
+
+    def release(self, buffer: BatchBuffer):
+        with self._lock:
+            if len(self._free) < self.max_buffers:
+                self._free.append(buffer)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "buffers": self.max_buffers,
+                "free": len(self._free),
+                "bytes": self.max_buffers * self.buffer_bytes,
+                "acquired": self.acquired,
+                "overflows": self.overflows,
+            }
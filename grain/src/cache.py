@@ -0,0 +1,264 @@
+import hashlib
+import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+
+import numpy as np
+
+from logger import logger
+
+# The on-disk tier lives in this subdirectory of the configured directory,
+# so that nothing else in it is ever touched
+DISK_NAMESPACE = "grain-result-cache"
+
+# Cache versions are the first 16 hex digits of a sha256
+VERSION_PATTERN = re.compile(r"[0-9a-f]{16}")
+
+
+def content_key(data: bytes, *parts: object) -> str:
+    """
+    sha256 of `data` followed by the repr of every part.
+    """
+    digest = hashlib.sha256(data)
+    for part in parts:
+        digest.update(b"\0" + repr(part).encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Two-tier cache of serialized results: an in-memory LRU bounded by
+    `max_bytes` and, if `disk_dir` is set, an on-disk tier bounded by
+    `disk_max_bytes` that survives restarts.
+    Disk entries live under `disk_dir/grain-result-cache/<version>/`; the
+    directories of other versions in there are removed on startup, so a
+    model or pipeline version change invalidates them.
+    """
+
+    def __init__(
+        self,
+        version: str,
+        max_bytes: int,
+        disk_dir: str | None = None,
+        disk_max_bytes: int = 0,
+    ):
+        self.max_bytes = max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.disk_dir = None
+        if disk_dir and disk_max_bytes > 0:
+            namespace = os.path.join(disk_dir, DISK_NAMESPACE)
+            self.disk_dir = os.path.join(namespace, version)
+            os.makedirs(self.disk_dir, exist_ok=True)
+            for name in os.listdir(namespace):
+                path = os.path.join(namespace, name)
+                if (
+                    name != version
+                    and VERSION_PATTERN.fullmatch(name)
+                    and os.path.isdir(path)
+                ):
+                    logger.info(f"Removing stale result cache {path}")
+                    shutil.rmtree(path, ignore_errors=True)
+            self._disk_size = sum(
+                entry.stat().st_size for entry in os.scandir(self.disk_dir)
+            )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 or self.disk_dir is not None
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+        value = self._disk_get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self._memory_put(key, value)
+        return value
+
+    def put(self, key: str, value: bytes):
+        self._memory_put(key, value)
+        self._disk_put(key, value)
+
+    def _memory_put(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key)
+
+    def _disk_get(self, key: str) -> bytes | None:
+        if self.disk_dir is None:
+            return None
+        try:
+            with open(self._disk_path(key), "rb") as f:
+                value = f.read()
+            # Keep recently used entries last in line for eviction
+            os.utime(self._disk_path(key))
+            return value
+        except OSError:
+            return None
+
+    def _disk_put(self, key: str, value: bytes):
+        if self.disk_dir is None or len(value) > self.disk_max_bytes:
+            return
+        path = self._disk_path(key)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(value)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning(f"Could not write result cache entry: {e}")
+            return
+
+        with self._lock:
+            self._disk_size += len(value)
+            if self._disk_size > self.disk_max_bytes:
+                self._disk_evict()
+
+    def _disk_evict(self):
+        """
+        Removes the least recently used files until the disk tier is at
+        90% of its budget. Called with the lock held.
+        """
+        entries = sorted(os.scandir(self.disk_dir), key=lambda e: e.stat().st_mtime)
+        self._disk_size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self._disk_size <= 0.9 * self.disk_max_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self._disk_size -= size
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                "disk_bytes": self._disk_size if self.disk_dir else 0,
+            }
+
+
+class ResultCacheSettings(NamedTuple):
+    """
+    How the result cache is sized, and what a cached result depends on
+    besides the request: the model and pipeline `version`, the `max_tiles`
+    used when a request sets none and the pipeline `settings`. Inference
+    workers send theirs to the API process, which then looks results up
+    itself.
+    """
+
+    version: str
+    max_tiles: int
+    settings: tuple
+    max_bytes: int
+    disk_dir: str | None = None
+    disk_max_bytes: int = 0
+
+    def key(
+        self, image_digest: str, coin, mm_per_pixel: float, max_tiles: int | None
+    ) -> str:
+        return content_key(
+            image_digest.encode(),
+            mm_per_pixel,
+            coin and coin.model_dump(),
+            self.max_tiles if max_tiles is None else max_tiles,
+            self.version,
+            self.settings,
+        )
+
+    def new_cache(self) -> ResultCache:
+        return ResultCache(
+            self.version, self.max_bytes, self.disk_dir, self.disk_max_bytes
+        )
+
+
+class TileCache:
+    """
+    In-memory LRU of per-tile predictions, keyed by a hash of the
+    preprocessed tile pixels and the model version, bounded by `max_entries`.
+    """
+
+    def __init__(self, version: str, max_entries: int):
+        self.version = version.encode()
+        self.max_entries = max_entries
+        self._entries: OrderedDict[bytes, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def key(self, tile: np.ndarray) -> bytes:
+        digest = hashlib.blake2b(self.version, digest_size=16)
+        digest.update(f"{tile.shape}{tile.dtype}".encode())
+        digest.update(np.ascontiguousarray(tile).data)
+        return digest.digest()
+
+    def get_many(self, keys: list[bytes]) -> list[np.ndarray | None]:
+        values = []
+        with self._lock:
+            for key in keys:
+                value = self._entries.get(key)
+                if value is not None:
+                    self._entries.move_to_end(key)
+                values.append(value)
+            found = sum(value is not None for value in values)
+            self.hits += found
+            self.misses += len(keys) - found
+        return values
+
+    def put_many(self, keys: list[bytes], values: np.ndarray):
+        with self._lock:
+            for key, value in zip(keys, values):
+                self._entries[key] = np.array(value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -1,63 +1,277 @@
-from helpers import get_image_from_bytes
+from batcher import MicroBatcher
+from buffers import BatchBufferPool
+from cache import ResultCacheSettings, TileCache, content_key
 from models import Coin, PredictionResponse
-from sedinet.predict import predict_grain_size
+from PIL import Image
+from preprocessing import (
+    CANONICAL_MM_PER_PIXEL,
+    TILE_FILTER,
+    TILE_MAX_SATURATED,
+    TILE_MIN_ENTROPY,
+    TILE_MIN_FOCUS,
+    TILE_OVERLAP,
+    TILE_SIZE,
+    decode_settings,
+    prepare_tiles,
+    preprocess_image,
+    tile_size_px,
+)
+from sedinet.predict import (
+    BACKEND,
+    LOAD_S,
+    IM_HEIGHT,
+    IM_WIDTH,
+    MAX_BATCH_SIZE,
+    MODEL_VERSION,
+    active_precision,
+    batch_sizes_used,
+    greyscale,
+    padded_batches,
+    predict_grain_size_batch,
+    vars as sedinet_vars,
+)
+import io
 import numpy as np
+import os
+import time
+from typing import Callable
 from logger import logger
 
-TILE_SIZE = 1024
+# Most tiles run through SediNet per request; larger grids are subsampled
+MAX_TILES = int(os.getenv("GRAIN_MAX_TILES", "32"))
 
+# Adaptive mode: run tiles in small random batches and stop once the
+# bootstrap confidence interval of the median of every percentile is within
+# ADAPTIVE_TOLERANCE (relative) of the median itself
+ADAPTIVE = os.getenv("GRAIN_ADAPTIVE", "false").lower() == "true"
+ADAPTIVE_BATCH = int(os.getenv("GRAIN_ADAPTIVE_BATCH", "4"))
+ADAPTIVE_MIN_TILES = int(os.getenv("GRAIN_ADAPTIVE_MIN_TILES", "8"))
+ADAPTIVE_TOLERANCE = float(os.getenv("GRAIN_ADAPTIVE_TOLERANCE", "0.05"))
+ADAPTIVE_CONFIDENCE = 0.9
+ADAPTIVE_RESAMPLES = 200
 
-def prepare_tiles(img: np.ndarray, coin: Coin | None) -> list[np.ndarray]:
+# Result cache keyed by image content, request inputs and model version.
+# GRAIN_CACHE_MAX_MB=0 disables the in-memory tier; GRAIN_CACHE_DIR enables
+# the on-disk tier
+CACHE_MAX_MB = float(os.getenv("GRAIN_CACHE_MAX_MB", "64"))
+CACHE_DIR = os.getenv("GRAIN_CACHE_DIR")
+CACHE_DISK_MAX_MB = float(os.getenv("GRAIN_CACHE_DISK_MAX_MB", "1024"))
+
+# Batch tiles of concurrent requests together: a batch is run once it has
+# MAX_BATCH_SIZE tiles or its oldest tiles have waited MICRO_BATCH_WAIT_MS
+MICRO_BATCHING = os.getenv("GRAIN_MICRO_BATCHING", "false").lower() == "true"
+MICRO_BATCH_WAIT_MS = float(os.getenv("GRAIN_MICRO_BATCH_WAIT_MS", "10"))
+
+# Preallocated batch buffers, one per concurrent SediNet call; calls beyond
+# that allocate one-off buffers
+BATCH_BUFFERS = int(os.getenv("GRAIN_BATCH_BUFFERS", "2"))
+
+# Per-tile prediction cache size, in tiles (0 disables it)
+TILE_CACHE_ENTRIES = int(os.getenv("GRAIN_TILE_CACHE_ENTRIES", "50000"))
+
+# Run synthetic inputs through the pipeline at startup, before reporting ready
+WARMUP = os.getenv("GRAIN_WARMUP", "true").lower() == "true"
+
+# Run all tiles of an image through SediNet in one batch; "false" uses the per-tile path
+BATCHED_INFERENCE = os.getenv("GRAIN_BATCHED_INFERENCE", "true").lower() == "true"
+
+
+tile_cache = TileCache(MODEL_VERSION, max_entries=TILE_CACHE_ENTRIES)
+
+batch_buffers = BatchBufferPool(
+    BATCH_BUFFERS,
+    MAX_BATCH_SIZE,
+    (IM_HEIGHT, IM_WIDTH, 1 if greyscale == True else 3),
+    len(sedinet_vars),
+)
+
+
+def predict_batch(
+    tiles: list[np.ndarray],
+    out: np.ndarray | None = None,
+    stats: dict | None = None,
+) -> np.ndarray:
+    """
+    Runs SediNet on at most MAX_BATCH_SIZE tiles, copied into a pooled batch
+    buffer, and writes the predictions into `out`. Runtimes that only take
+    full batches are given the whole buffer; its rows past the tiles hold
+    earlier tiles, whose predictions are ignored. A buffer that had to be
+    allocated because the pool was exhausted is counted in
+    stats["batch_buffer_overflows"].
+    Returns `out`, of shape (num_tiles, 9).
+    """
+    n = len(tiles)
+    if out is None:
+        out = np.empty((n, len(sedinet_vars)))
+
+    buffer, overflowed = batch_buffers.acquire()
+    try:
+        for i, tile in enumerate(tiles):
+            buffer.tiles[i] = tile
+        size = MAX_BATCH_SIZE if padded_batches() else n
+        predict_grain_size_batch(buffer.tiles[:size], out=buffer.predictions[:size])
+        out[...] = buffer.predictions[:n]
+    finally:
+        batch_buffers.release(buffer)
+
+    if stats is not None:
+        stats["batch_buffer_overflows"] = (
+            stats.get("batch_buffer_overflows", 0) + overflowed
+        )
+    return out
+
+
+micro_batcher = (
+    MicroBatcher(
+        predict_batch,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_wait_s=MICRO_BATCH_WAIT_MS / 1000,
+    )
+    if MICRO_BATCHING
+    else None
+)
+
+
+def predict_tiles(
+    tiles: list[np.ndarray], batched: bool, stats: dict | None = None
+) -> np.ndarray:
+    """
+    Predicts every tile, running SediNet only on tiles not in the tile cache.
+    Adds the number of cache hits to stats["tile_cache_hits"].
+    Returns an array of shape (num_tiles, 9).
+    """
+    if not tile_cache.enabled:
+        return run_sedinet(tiles, batched, stats)
+
+    keys = [tile_cache.key(tile) for tile in tiles]
+    predictions = tile_cache.get_many(keys)
+    missing = [i for i, p in enumerate(predictions) if p is None]
+    if stats is not None:
+        stats["tile_cache_hits"] += len(tiles) - len(missing)
+
+    if missing:
+        computed = run_sedinet([tiles[i] for i in missing], batched, stats)
+        tile_cache.put_many([keys[i] for i in missing], computed)
+        for i, prediction in zip(missing, computed):
+            predictions[i] = prediction
+
+    return np.stack(predictions)
+
+
+def run_sedinet(
+    tiles: list[np.ndarray], batched: bool, stats: dict | None = None
+) -> np.ndarray:
     """
-    Crops the image into squares for the AI, avoiding the coin.
+    Runs SediNet on every tile.
+    Returns an array of shape (num_tiles, 9).
     """
-    logger.info("[*] Tiling image for analysis...")
+    if batched:
+        starts = range(0, len(tiles), MAX_BATCH_SIZE)
+        if micro_batcher is not None:
+            futures = [
+                micro_batcher.submit(tiles[start : start + MAX_BATCH_SIZE], stats)
+                for start in starts
+            ]
+            return np.concatenate([future.result() for future in futures])
 
-    tiles: list[np.ndarray] = []
-    h, w, _ = img.shape
+        predictions = np.empty((len(tiles), len(sedinet_vars)))
+        for start in starts:
+            chunk = tiles[start : start + MAX_BATCH_SIZE]
+            predict_batch(chunk, predictions[start : start + len(chunk)], stats)
+        return predictions
 
-    # Simple sliding window
-    step = TILE_SIZE
-    for y in range(0, h - step, step):
-        for x in range(0, w - step, step):
-            # Check if this tile overlaps with the coin (basic box collision)
-            # We add a buffer to the coin radius to be safe
-            if (
-                coin is not None
-                and x < coin.center_x + coin.radius_px + 50
-                and x + step > coin.center_x - coin.radius_px - 50
-                and y < coin.center_y + coin.radius_px + 50
-                and y + step > coin.center_y - coin.radius_px - 50
-            ):
-                continue  # Skip this tile, it contains the coin
+    all_predictions: list[np.ndarray] = []
+    for tile in tiles:
+        # Returns [P10, P16, P25, P50, P50mean, P65, P75, P84, P90]
+        predictions = predict_grain_size_batch(tile[np.newaxis])[0]
+        all_predictions.append(predictions)
 
-            tile = img[y : y + TILE_SIZE, x : x + TILE_SIZE]
-            tiles.append(tile)
+    return np.array(all_predictions)
 
-    logger.info(f"    - Generated {len(tiles)} valid sand tiles.")
 
-    return tiles
+def median_converged(predictions: np.ndarray, rng: np.random.Generator) -> bool:
+    """
+    Whether the bootstrap confidence interval of the median of every column
+    is within ADAPTIVE_TOLERANCE of the median.
+    """
+    n = len(predictions)
+    resampled = predictions[rng.integers(0, n, size=(ADAPTIVE_RESAMPLES, n))]
+    medians = np.median(resampled, axis=1)
+
+    alpha = (1 - ADAPTIVE_CONFIDENCE) / 2
+    low, high = np.quantile(medians, [alpha, 1 - alpha], axis=0)
+    half_width = (high - low) / 2
+
+    return bool(
+        np.all(
+            half_width <= ADAPTIVE_TOLERANCE * np.abs(np.median(predictions, axis=0))
+        )
+    )
 
 
-def run_sedinet_analysis(tiles: list[np.ndarray]):
+def predict_until_converged(
+    tiles: list[np.ndarray], batched: bool, stats: dict | None = None
+) -> np.ndarray:
+    """
+    Runs SediNet on the tiles in random order, ADAPTIVE_BATCH at a time,
+    until the median has converged.
+    Returns the predictions of the tiles that were run, shape (num_run, 9).
+    """
+    rng = np.random.default_rng(0)
+    order = rng.permutation(len(tiles))
+
+    predictions: list[np.ndarray] = []
+    num_run = 0
+    for start in range(0, len(order), ADAPTIVE_BATCH):
+        batch = [tiles[i] for i in order[start : start + ADAPTIVE_BATCH]]
+        predictions.append(predict_tiles(batch, batched, stats))
+        num_run += len(batch)
+
+        if num_run >= ADAPTIVE_MIN_TILES and median_converged(
+            np.concatenate(predictions), rng
+        ):
+            break
+
+    return np.concatenate(predictions)
+
+
+def run_sedinet_analysis(
+    tiles: list[np.ndarray],
+    stats: dict | None = None,
+    batched: bool = BATCHED_INFERENCE,
+    adaptive: bool = ADAPTIVE,
+) -> np.ndarray | None:
     """
     Passes the tiles to the SediNet model.
+    Returns the median prediction (px). The number of tiles it used, the
+    tile cache hits and the batch buffer pool overflows are recorded in stats.
     """
+    if stats is None:
+        stats = {"tiles_used": 0, "tile_cache_hits": 0, "batch_buffer_overflows": 0}
+
     logger.info("[*] Running SediNet Model...")
 
     try:
-        all_predictions: list[list[float]] = []
-        for tile in tiles:
-            # Returns [P10, P16, P25, P50, P50mean, P65, P75, P84, P90]
-            predictions = predict_grain_size(tile)
-            all_predictions.append(predictions)
-
-        if not all_predictions:
+        if not tiles:
             return None
 
-        # Convert to numpy array for easy column-wise operations
         # Shape: (num_tiles, 9)
-        all_predictions_np = np.array(all_predictions)
+        start = time.perf_counter()
+        if adaptive:
+            all_predictions_np = predict_until_converged(tiles, batched, stats)
+        else:
+            all_predictions_np = predict_tiles(tiles, batched, stats)
+        stats["tiles_used"] = len(all_predictions_np)
+        logger.info(
+            f"    - SediNet inference on {len(all_predictions_np)}/{len(tiles)} "
+            f"tiles took {time.perf_counter() - start:.3f}s "
+            f"(backend={BACKEND}, precision={active_precision()}, "
+            f"tile cache hits {stats['tile_cache_hits']}/{len(all_predictions_np)})"
+        )
+        logger.debug(
+            f"    - Batch buffer pool overflows: {stats['batch_buffer_overflows']} "
+            f"(pool: {batch_buffers.stats()})"
+        )
 
         # Calculate median for each percentile across all tiles
         aggregated_preds = np.median(all_predictions_np, axis=0)
@@ -73,29 +287,168 @@ def run_sedinet_analysis(tiles: list[np.ndarray]):
 
 percentiles = ["10", "16", "25", "50", "50mean", "65", "75", "84", "90"]
 
+# Settings that change the output for the same image and model
+PIPELINE_SETTINGS = (
+    TILE_SIZE,
+    CANONICAL_MM_PER_PIXEL,
+    TILE_FILTER and (TILE_MAX_SATURATED, TILE_MIN_FOCUS, TILE_MIN_ENTROPY),
+    TILE_OVERLAP,
+    ADAPTIVE and (ADAPTIVE_BATCH, ADAPTIVE_MIN_TILES, ADAPTIVE_TOLERANCE),
+)
+
+# Bump whenever a code change alters results for the same image and settings
+# (decoding, preprocessing, tiling, the quality filter, aggregation or the
+# response fields), so that results cached by earlier code are not served.
+# It is part of the cache version, so on-disk entries of earlier pipeline
+# versions are removed on startup
+PIPELINE_VERSION = 1
+
+RESULT_CACHE_SETTINGS = ResultCacheSettings(
+    content_key(MODEL_VERSION.encode(), PIPELINE_VERSION)[:16],
+    MAX_TILES,
+    PIPELINE_SETTINGS,
+    max_bytes=int(CACHE_MAX_MB * 2**20),
+    disk_dir=CACHE_DIR,
+    disk_max_bytes=int(CACHE_DISK_MAX_MB * 2**20),
+)
+result_cache = RESULT_CACHE_SETTINGS.new_cache()
+
+
+# How the service decodes uploads; also used by processes that decode
+# images on behalf of the inference workers
+DECODE_SETTINGS = decode_settings(IM_HEIGHT, greyscale == True)
+
+
+def decode_image(
+    image_bytes: bytes, mm_per_pixel: float | None = None
+) -> tuple[Image.Image, float]:
+    return DECODE_SETTINGS.decode(image_bytes, mm_per_pixel)
+
 
 def run_inference(
-    image_bytes: bytes, coin: Coin | None, mm_per_pixel: float
+    image_bytes: bytes,
+    coin: Coin | None,
+    mm_per_pixel: float,
+    max_tiles: int | None = None,
 ) -> PredictionResponse:
-    image = get_image_from_bytes(image_bytes)
-    img = np.array(image)
+    return run_inference_decoded(
+        content_key(image_bytes),
+        lambda: decode_image(image_bytes, mm_per_pixel),
+        coin,
+        mm_per_pixel,
+        max_tiles,
+    )
+
+
+def run_inference_decoded(
+    image_digest: str,
+    decode: Callable[[], tuple[Image.Image, float]],
+    coin: Coin | None,
+    mm_per_pixel: float,
+    max_tiles: int | None = None,
+    cache_results: bool = True,
+) -> PredictionResponse:
+    """
+    run_inference for an image identified by the digest of its bytes;
+    `decode` returns the decoded image and its scale, and is only called
+    on a result cache miss. Without `cache_results` the result cache is
+    left to the caller.
+    """
+    max_tiles = MAX_TILES if max_tiles is None else max_tiles
 
-    tiles = prepare_tiles(img, coin)
+    key = None
+    if cache_results and result_cache.enabled:
+        key = RESULT_CACHE_SETTINGS.key(image_digest, coin, mm_per_pixel, max_tiles)
+        cached = result_cache.get(key)
+        if cached is not None:
+            logger.info("[*] Returning cached result.")
+            return PredictionResponse.model_validate_json(cached)
+
+    image, scale = decode()
+    response = analyse_image(image, scale, coin, mm_per_pixel, max_tiles)
+
+    if key is not None:
+        result_cache.put(key, response.model_dump_json().encode())
+
+    return response
+
+
+def analyse_image(
+    image: Image.Image,
+    scale: float,
+    coin: Coin | None,
+    mm_per_pixel: float,
+    max_tiles: int,
+) -> PredictionResponse:
+    tile_size = tile_size_px(mm_per_pixel)
+    img, scale = preprocess_image(image, scale, tile_size, IM_HEIGHT, greyscale == True)
+
+    stats = {
+        "tiles_used": 0,
+        "tile_cache_hits": 0,
+        "batch_buffer_overflows": 0,
+        "tiles_rejected": {},
+        "tile_filter_bypassed": False,
+    }
+    tiles = prepare_tiles(
+        img, coin, scale, max_tiles=max_tiles, tile_size=tile_size, stats=stats
+    )
     if not tiles:
         raise ValueError("No valid sand tiles could be generated from the image.")
 
-    grain_size_results_px = run_sedinet_analysis(tiles)
+    grain_size_results_px = run_sedinet_analysis(tiles, stats)
 
     if grain_size_results_px is None:
         raise ValueError("SediNet analysis failed to produce results.")
 
+    # SediNet measures in pixels of a TILE_SIZE tile; with physical-scale
+    # tiling these are CANONICAL_MM_PER_PIXEL mm
+    mm_per_output_px = mm_per_pixel * tile_size / TILE_SIZE
+
     results = {}
     for perc, size in zip(percentiles, grain_size_results_px):
-        results[f"D{perc}"] = size * mm_per_pixel
+        results[f"D{perc}"] = size * mm_per_output_px
 
     logger.info(f"Final grain size results (mm): {results}")
 
     return PredictionResponse(
-        size_mm=grain_size_results_px[3] * mm_per_pixel,
+        size_mm=grain_size_results_px[3] * mm_per_output_px,
         distribution_mm=results,
+        tiles_used=stats["tiles_used"],
+        tiles_skipped=len(tiles) - stats["tiles_used"],
+        tile_cache_hits=stats["tile_cache_hits"],
+        tiles_rejected=stats["tiles_rejected"],
+        tile_filter_bypassed=stats["tile_filter_bypassed"],
     )
+
+
+def warm_up() -> dict:
+    """
+    Runs synthetic inputs through SediNet at every batch size it can be
+    called with, then one synthetic upload through the whole pipeline, so
+    that graph tracing, kernel selection and buffer allocation happen before
+    the first request. Returns how long each step took, in seconds, after
+    the time it took to load the model.
+    """
+    rng = np.random.default_rng(0)
+    channels = 1 if greyscale == True else 3
+    timings = {"model_load": LOAD_S}
+
+    for n in batch_sizes_used():
+        tiles = rng.integers(0, 256, (n, IM_HEIGHT, IM_WIDTH, channels), dtype=np.uint8)
+        start = time.perf_counter()
+        predict_grain_size_batch(tiles)
+        timings[f"batch_{n}"] = round(time.perf_counter() - start, 3)
+
+    # Decoding, tiling, batching and aggregation of a 2x2 tile image
+    pixels = rng.integers(0, 256, (2 * TILE_SIZE, 2 * TILE_SIZE, 3), dtype=np.uint8)
+    upload = io.BytesIO()
+    Image.fromarray(pixels).save(upload, format="JPEG")
+
+    start = time.perf_counter()
+    mm_per_pixel = CANONICAL_MM_PER_PIXEL or 1.0
+    image, scale = decode_image(upload.getvalue(), mm_per_pixel)
+    analyse_image(image, scale, None, mm_per_pixel, MAX_TILES)
+    timings["pipeline"] = round(time.perf_counter() - start, 3)
+
+    return timings
@@ -1,5 +1,5 @@
 from fastapi import UploadFile
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class Coin(BaseModel):
@@ -13,9 +13,21 @@ class PredictionRequest(BaseModel):
     coin_center_x: int | None
     coin_center_y: int | None
     coin_radius_px: int | None
+    # Upper bound on the tiles analysed for this image (0 = no limit)
+    max_tiles: int | None = Field(None, ge=0)
     image: UploadFile
 
 
 class PredictionResponse(BaseModel):
     size_mm: float
     distribution_mm: dict[str, float]
+    # Tiles SediNet ran on, and valid tiles left out once the median converged
+    tiles_used: int = 0
+    tiles_skipped: int = 0
+    # Tiles whose prediction came from the tile cache
+    tile_cache_hits: int = 0
+    # Tiles the quality filter dropped before inference, by reason
+    # ("saturated", "blurred", "low_texture")
+    tiles_rejected: dict[str, int] = {}
+    # Every tile failed the quality filter, so they were analysed unfiltered
+    tile_filter_bypassed: bool = False
@@ -0,0 +1,176 @@
+import math
+import os
+
+import numpy as np
+from PIL import Image
+
+from decode import DecodeSettings
+from logger import logger
+from models import Coin
+from quality import filter_tiles
+from tiling import overlaps_box, stratified_subset, tile_grid
+
+# How an upload is cut into SediNet input tiles. Shared by the service and
+# the offline tools (int8 calibration), so that both see the same tiles
+
+TILE_SIZE = 1024
+
+# Physical-scale tiling: every image is resampled so that a pixel covers
+# CANONICAL_MM_PER_PIXEL, the ground resolution SediNet was trained at, and
+# tiled in TILE_SIZE pixels of that resolution, so that a tile is a fixed
+# area of sand whatever the camera. The work per request then follows the
+# sand area instead of the megapixels, and SediNet's pixel outputs are all
+# at the training scale. 0 tiles in TILE_SIZE pixels of the upload
+CANONICAL_MM_PER_PIXEL = float(os.getenv("GRAIN_CANONICAL_MM_PER_PIXEL", "0"))
+
+# Fraction of a tile that neighbouring tiles share (0 = edge to edge)
+TILE_OVERLAP = float(os.getenv("GRAIN_TILE_OVERLAP", "0"))
+if not 0 <= TILE_OVERLAP < 1:
+    raise ValueError(f"GRAIN_TILE_OVERLAP must be in [0, 1), got {TILE_OVERLAP}")
+
+# Extra margin around the coin, in original pixels
+COIN_MARGIN_PX = 50
+
+# Drop tiles that are not worth running SediNet on before the max_tiles
+# subset is drawn: more than TILE_MAX_SATURATED of their pixels clipped to
+# black or white, blurred (Laplacian variance below TILE_MIN_FOCUS, in grey
+# levels squared) or textureless like shoes, rulers and shadows (grey-level
+# entropy below TILE_MIN_ENTROPY bits)
+TILE_FILTER = os.getenv("GRAIN_TILE_FILTER", "true").lower() == "true"
+TILE_MAX_SATURATED = float(os.getenv("GRAIN_TILE_MAX_SATURATED", "0.2"))
+TILE_MIN_FOCUS = float(os.getenv("GRAIN_TILE_MIN_FOCUS", "15"))
+TILE_MIN_ENTROPY = float(os.getenv("GRAIN_TILE_MIN_ENTROPY", "4.0"))
+
+
+def decode_settings(input_size: int, greyscale: bool) -> DecodeSettings:
+    """
+    How uploads are decoded for a model with `input_size` px tiles: JPEGs
+    are decoded straight to (at most) the scale the model sees a tile at.
+    """
+    return DecodeSettings(
+        greyscale=greyscale,
+        pixels_per_input=TILE_SIZE / input_size,
+        mm_per_input=CANONICAL_MM_PER_PIXEL * TILE_SIZE / input_size or None,
+    )
+
+
+def tile_size_px(mm_per_pixel: float) -> float:
+    """
+    Size of a tile in pixels of the original image: TILE_SIZE, or with
+    physical-scale tiling the TILE_SIZE canonical pixels' worth of sand.
+    """
+    if not CANONICAL_MM_PER_PIXEL:
+        return TILE_SIZE
+    if mm_per_pixel <= 0:
+        raise ValueError("Physical-scale tiling needs a positive mm_per_pixel.")
+    return TILE_SIZE * CANONICAL_MM_PER_PIXEL / mm_per_pixel
+
+
+def preprocess_image(
+    image: Image.Image,
+    scale: float,
+    tile_size: float,
+    input_size: int,
+    greyscale: bool,
+) -> tuple[np.ndarray, float]:
+    """
+    Converts the whole image to the model's colour mode and resamples it
+    once with area interpolation, so that a `tile_size` tile of the original
+    becomes an `input_size` tile of the result.
+    `scale` is the size of the decoded image relative to the original.
+    Returns the uint8 raster with a channel axis, and its scale; SediNet
+    rescales the pixels to [0, 1] in its graph.
+    """
+    image = image.convert("L" if greyscale else "RGB")
+
+    target = input_size / tile_size
+    if not math.isclose(scale, target, rel_tol=1e-2):
+        factor = scale / target
+        width = image.width
+        if factor.is_integer():
+            image = image.reduce(int(factor))
+        else:
+            size = (round(image.width / factor), round(image.height / factor))
+            image = image.resize(size, Image.Resampling.BOX)
+        scale *= image.width / width
+
+    raster = np.asarray(image)
+    if raster.ndim == 2:
+        raster = raster[:, :, np.newaxis]
+
+    return raster, scale
+
+
+def prepare_tiles(
+    img: np.ndarray,
+    coin: Coin | None,
+    scale: float = 1.0,
+    max_tiles: int = 0,
+    overlap: float = TILE_OVERLAP,
+    tile_size: float = TILE_SIZE,
+    stats: dict | None = None,
+) -> list[np.ndarray]:
+    """
+    Crops the image into squares for the AI, avoiding the coin.
+    `scale` is the size of an img pixel relative to the original image, in
+    which the coin and `tile_size` are given. Tiles are views into img.
+    The grid covers the image edge to edge; tiles that fail the quality
+    filter are dropped, and the number dropped for each reason is recorded
+    in stats["tiles_rejected"]. If every tile fails the filter, all of them
+    are kept and stats["tile_filter_bypassed"] is set, since the image will
+    not get any better on a retry. If more than `max_tiles` tiles remain
+    (0 = no limit), a spatially stratified subset is used.
+    """
+    logger.info("[*] Tiling image for analysis...")
+
+    h, w, _ = img.shape
+    step = round(tile_size * scale)
+    stride = max(1, round(step * (1 - overlap)))
+
+    origins = tile_grid(h, w, step, stride)
+    num_grid = len(origins)
+
+    if coin is not None:
+        # Basic box collision, with a margin around the coin to be safe
+        reach = (coin.radius_px + COIN_MARGIN_PX) * scale
+        coin_x = coin.center_x * scale
+        coin_y = coin.center_y * scale
+        box = (coin_x - reach, coin_y - reach, coin_x + reach, coin_y + reach)
+        origins = origins[~overlaps_box(origins, step, box)]
+
+    num_clear = len(origins)
+    rejected = {}
+    if TILE_FILTER and num_clear:
+        kept, rejected = filter_tiles(
+            [img[y : y + step, x : x + step] for y, x in origins],
+            max_saturated=TILE_MAX_SATURATED,
+            min_focus=TILE_MIN_FOCUS,
+            min_entropy=TILE_MIN_ENTROPY,
+        )
+        if len(kept):
+            origins = origins[kept]
+        else:
+            logger.warning(
+                f"    - Every tile failed the quality filter ({rejected}), "
+                "analysing them unfiltered."
+            )
+            if stats is not None:
+                stats["tile_filter_bypassed"] = True
+    if stats is not None:
+        stats["tiles_rejected"] = rejected
+
+    num_valid = len(origins)
+    if max_tiles and num_valid > max_tiles:
+        # Deterministic, so a resubmitted image gets the same tiles
+        rng = np.random.default_rng(0)
+        origins = origins[stratified_subset(origins, max_tiles, rng)]
+
+    tiles = [img[y : y + step, x : x + step] for y, x in origins]
+
+    logger.info(
+        f"    - Generated {len(tiles)} valid sand tiles "
+        f"({num_grid} in grid, {num_grid - num_clear} overlapping the coin, "
+        f"{num_clear - num_valid} rejected by the quality filter: {rejected})."
+    )
+
+    return tiles
@@ -0,0 +1,92 @@
+import numpy as np
+
+# Why a tile is rejected, in the order the checks are made
+SATURATED = "saturated"
+BLURRED = "blurred"
+LOW_TEXTURE = "low_texture"
+REASONS = (SATURATED, BLURRED, LOW_TEXTURE)
+
+# Grey levels counted as clipped to black or white
+DARK_LEVEL = 5
+BRIGHT_LEVEL = 250
+
+
+def tile_scores(tiles: np.ndarray) -> dict[str, np.ndarray]:
+    """
+    Cheap quality statistics of a (N, H, W, C) uint8 batch of tiles, one
+    value per tile:
+    "focus", the variance of the 4-neighbour Laplacian (low when blurred);
+    "saturated", the fraction of pixels clipped to black or white;
+    "entropy", of the grey-level histogram in bits (low when textureless).
+    """
+    grey = tiles[..., 0] if tiles.shape[-1] == 1 else tiles.mean(axis=-1)
+    n = len(grey)
+
+    x = grey.astype(np.float32)
+    laplacian = (
+        4 * x[:, 1:-1, 1:-1]
+        - x[:, :-2, 1:-1]
+        - x[:, 2:, 1:-1]
+        - x[:, 1:-1, :-2]
+        - x[:, 1:-1, 2:]
+    )
+    focus = laplacian.reshape(n, -1).var(axis=1)
+
+    levels = grey.reshape(n, -1).astype(np.intp)
+    histograms = np.bincount(
+        (levels + 256 * np.arange(n)[:, np.newaxis]).ravel(), minlength=256 * n
+    ).reshape(n, 256)
+    p = histograms / levels.shape[1]
+
+    saturated = p[:, : DARK_LEVEL + 1].sum(axis=1) + p[:, BRIGHT_LEVEL:].sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        entropy = np.where(p > 0, -p * np.log2(p), 0).sum(axis=1)
+
+    return {"focus": focus, "saturated": saturated, "entropy": entropy}
+
+
+def rejection_reasons(
+    scores: dict[str, np.ndarray],
+    max_saturated: float,
+    min_focus: float,
+    min_entropy: float,
+) -> np.ndarray:
+    """
+    The first check each tile fails, or "" for tiles that pass them all.
+    """
+    return np.select(
+        [
+            scores["saturated"] > max_saturated,
+            scores["focus"] < min_focus,
+            scores["entropy"] < min_entropy,
+        ],
+        list(REASONS),
+        default="",
+    )
+
+
+def filter_tiles(
+    tiles: list[np.ndarray],
+    max_saturated: float,
+    min_focus: float,
+    min_entropy: float,
+    chunk_size: int = 16,
+) -> tuple[np.ndarray, dict[str, int]]:
+    """
+    Scores the tiles `chunk_size` at a time and drops those that fail a
+    check. Returns the indices of the kept tiles and the number of tiles
+    rejected for each reason.
+    """
+    reasons = np.concatenate(
+        [
+            rejection_reasons(
+                tile_scores(np.stack(tiles[start : start + chunk_size])),
+                max_saturated,
+                min_focus,
+                min_entropy,
+            )
+            for start in range(0, len(tiles), chunk_size)
+        ]
+    )
+    rejected = {reason: int(np.sum(reasons == reason)) for reason in REASONS}
+    return np.flatnonzero(reasons == ""), rejected
@@ -0,0 +1,165 @@
+###===================================================
+## Runtimes that serve an exported SediNet model (see export.py).
+## Every backend takes a uint8 (N, IM_HEIGHT, IM_WIDTH, channels) batch, the
+## exported graphs rescale it to [0, 1] themselves, and returns the raw (N, members, len(vars)) output of the ensemble members,
+## before bias correction and the median over members.
+
+import os
+import threading
+
+import numpy as np
+
+SAVEDMODEL_NAME = "saved_model"
+TFLITE_NAME = "sedinet.tflite"
+TFLITE_INT8_NAME = "sedinet_int8.tflite"
+ONNX_NAME = "sedinet.onnx"
+ARTIFACT_NAME = "sedinet.pb"
+
+# constant nodes the artifact carries next to the frozen serving graph
+ARTIFACT_SIGNATURE = "sedinet_signature"
+ARTIFACT_BIAS = "sedinet_bias"
+ARTIFACT_VARS = "sedinet_vars"
+
+
+class SavedModelBackend:
+    name = "savedmodel"
+    # any batch size can be served without re-tracing
+    pad_batches = False
+
+    def __init__(self, path, num_threads=None):
+        import tensorflow as tf
+
+        self.tf = tf
+        self.model = tf.saved_model.load(path)
+        self.fn = self.model.serve
+
+    def predict(self, images):
+        return np.asarray(self.fn(self.tf.constant(images)))
+
+
+class TFLiteBackend:
+    name = "tflite"
+    # resizing the input tensor reallocates the interpreter, so keep one shape
+    pad_batches = True
+
+    def __init__(self, path, num_threads=None):
+        try:
+            from ai_edge_litert.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+
+            Interpreter = tf.lite.Interpreter
+
+        # the default CPU delegate is XNNPACK
+        self.interpreter = Interpreter(model_path=path, num_threads=num_threads)
+        input_details = self.interpreter.get_input_details()[0]
+        self.input_index = input_details["index"]
+        self.input_dtype = input_details["dtype"]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        self.batch_size = None
+        self.lock = threading.Lock()
+
+    def predict(self, images):
+        with self.lock:
+            if self.batch_size != len(images):
+                self.interpreter.resize_tensor_input(self.input_index, images.shape)
+                self.interpreter.allocate_tensors()
+                self.batch_size = len(images)
+            self.interpreter.set_tensor(
+                self.input_index, np.ascontiguousarray(images, dtype=self.input_dtype)
+            )
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.output_index).copy()
+
+
+class OnnxBackend:
+    name = "onnx"
+    pad_batches = False
+
+    def __init__(self, path, num_threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, images):
+        images = np.ascontiguousarray(images)
+        return self.session.run(None, {self.input_name: images})[0]
+
+
+class ArtifactBackend:
+    """
+    Serves the single-file artifact written by `python -m sedinet.export
+    --formats artifact`: a frozen GraphDef holding the serving graph with its
+    weights as constants, the bias-correction coefficients of every ensemble
+    member and the output variable names. Loading only parses the file
+    """
+
+    name = "artifact"
+    pad_batches = False
+
+    def __init__(self, path, num_threads=None):
+        import tensorflow as tf
+
+        self.tf = tf
+        graph_def = tf.compat.v1.GraphDef()
+        with open(path, "rb") as f:
+            graph_def.ParseFromString(f.read())
+
+        imported = tf.compat.v1.wrap_function(
+            lambda: tf.compat.v1.import_graph_def(graph_def, name=""), []
+        )
+        graph = imported.graph
+        metadata = imported.prune(
+            [],
+            [
+                graph.get_tensor_by_name(f"{ARTIFACT_SIGNATURE}:0"),
+                graph.get_tensor_by_name(f"{ARTIFACT_BIAS}:0"),
+                graph.get_tensor_by_name(f"{ARTIFACT_VARS}:0"),
+            ],
+        )
+        signature, bias, vars = [np.asarray(t) for t in metadata()]
+
+        input_name, output_name = [name.decode() for name in signature]
+        self.fn = imported.prune(
+            graph.get_tensor_by_name(input_name), graph.get_tensor_by_name(output_name)
+        )
+        # (members, len(vars), degree + 1) polynomial coefficients, or None
+        self.bias = bias if bias.size else None
+        self.vars = [v.decode() for v in vars]
+
+    def predict(self, images):
+        return np.asarray(self.fn(self.tf.constant(images)))
+
+
+BACKENDS = {
+    SavedModelBackend.name: (SavedModelBackend, SAVEDMODEL_NAME),
+    TFLiteBackend.name: (TFLiteBackend, TFLITE_NAME),
+    "tflite_int8": (TFLiteBackend, TFLITE_INT8_NAME),
+    OnnxBackend.name: (OnnxBackend, ONNX_NAME),
+    ArtifactBackend.name: (ArtifactBackend, ARTIFACT_NAME),
+}
+
+
+def load_backend(name, export_dir, num_threads=None):
+    """
+    This function loads the exported model at export_dir with the named runtime
+    """
+    if name not in BACKENDS:
+        raise ValueError(
+            f"Unknown SediNet backend '{name}', expected one of {sorted(BACKENDS)}"
+        )
+
+    backend, filename = BACKENDS[name]
+    path = os.path.join(export_dir, filename)
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f"No exported model at {path}. Run `python -m sedinet.export` first."
+        )
+
+    return backend(path, num_threads=num_threads)
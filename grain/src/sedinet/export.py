@@ -0,0 +1,237 @@
+###===================================================
+## Exports the configured SediNet model (CONFIG_PATH + WEIGHTS_PATH in
+## predict.py) for the non-keras backends and checks that every exported
+## file reproduces the Keras outputs.
+##
+## usage (from /app/src):
+##   python -m sedinet.export [--out DIR] [--formats savedmodel tflite onnx artifact]
+##
+## "artifact" is the prebuilt inference artifact: one file with the frozen
+## graph, its weights and the bias-correction coefficients, that the service
+## loads without building or compiling the model (SEDINET_BACKEND=artifact).
+##
+## The ONNX export needs tf2onnx, which is not part of the image: without
+## it, onnx is left out of the default formats and refused when asked for.
+
+import argparse
+import importlib.util
+import os
+import sys
+
+import numpy as np
+
+from . import predict
+from .backends import (
+    ARTIFACT_BIAS,
+    ARTIFACT_NAME,
+    ARTIFACT_SIGNATURE,
+    ARTIFACT_VARS,
+    ONNX_NAME,
+    SAVEDMODEL_NAME,
+    TFLITE_NAME,
+    load_backend,
+)
+from .sedinet_models import IM_HEIGHT, IM_WIDTH, tf
+
+
+def serving_model():
+    """
+    This function returns the Keras model the exports are made from, building
+    it from the configured weights if the service runs another backend
+    """
+    if predict.SM is None:
+        predict.load_model(
+            predict.vars,
+            predict.greyscale,
+            predict.dropout,
+            predict.scale,
+            predict.WEIGHTS_PATH,
+        )
+        if predict.OPTIMIZE_GRAPH:
+            predict.optimize_model(predict.vars, predict.greyscale)
+        predict.load_fused_model(predict.greyscale)
+
+    if predict.FM is None:
+        raise ValueError("Exporting needs the fused ensemble (SEDINET_FUSED_ENSEMBLE)")
+    return predict.FM
+
+
+def input_spec(greyscale):
+    channels = 1 if greyscale == True else 3
+    return tf.TensorSpec(
+        shape=(None, IM_HEIGHT, IM_WIDTH, channels), dtype=tf.uint8, name="images"
+    )
+
+
+def serving_fn(model, greyscale):
+    @tf.function(input_signature=[input_spec(greyscale)])
+    def serve(images):
+        outputs = model(images, training=False)
+        if isinstance(outputs, (list, tuple)):
+            outputs = tf.concat(outputs, axis=-1)
+        return outputs
+
+    return serve
+
+
+def save_serving_module(model, greyscale, path):
+    module = tf.Module()
+    module.model = model
+    module.serve = serving_fn(model, greyscale)
+    tf.saved_model.save(module, path, signatures={"serving_default": module.serve})
+
+
+def export_savedmodel(model, greyscale, out_dir):
+    path = os.path.join(out_dir, SAVEDMODEL_NAME)
+    save_serving_module(model, greyscale, path)
+    return path
+
+
+def export_tflite(model, greyscale, out_dir):
+    path = os.path.join(out_dir, TFLITE_NAME)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    with open(path, "wb") as f:
+        f.write(converter.convert())
+    return path
+
+
+def export_onnx(model, greyscale, out_dir, opset=17):
+    import tf2onnx
+
+    path = os.path.join(out_dir, ONNX_NAME)
+    tf2onnx.convert.from_function(
+        serving_fn(model, greyscale),
+        input_signature=[input_spec(greyscale)],
+        opset=opset,
+        output_path=path,
+    )
+    return path
+
+
+def export_artifact(model, greyscale, out_dir):
+    from tensorflow.python.framework.convert_to_constants import (
+        convert_variables_to_constants_v2,
+    )
+
+    path = os.path.join(out_dir, ARTIFACT_NAME)
+    frozen = convert_variables_to_constants_v2(
+        serving_fn(model, greyscale).get_concrete_function()
+    )
+    graph_def = frozen.graph.as_graph_def()
+
+    bias = predict.load_bias_coefficients()
+    metadata = tf.Graph()
+    with metadata.as_default():
+        tf.constant(
+            [frozen.inputs[0].name, frozen.outputs[0].name], name=ARTIFACT_SIGNATURE
+        )
+        tf.constant(
+            bias if bias is not None else np.zeros((0, 0, 0)),
+            dtype=tf.float64,
+            name=ARTIFACT_BIAS,
+        )
+        tf.constant(predict.vars, name=ARTIFACT_VARS)
+    graph_def.node.extend(metadata.as_graph_def().node)
+
+    with open(path, "wb") as f:
+        f.write(graph_def.SerializeToString())
+    return path
+
+
+EXPORTERS = {
+    "savedmodel": export_savedmodel,
+    "tflite": export_tflite,
+    "onnx": export_onnx,
+    "artifact": export_artifact,
+}
+
+# exports that need a package the image may not have
+EXPORT_REQUIRES = {"onnx": "tf2onnx"}
+
+
+def missing_requirement(name):
+    """
+    This function returns the package the name export needs but is not
+    installed, or None
+    """
+    package = EXPORT_REQUIRES.get(name)
+    if package is not None and importlib.util.find_spec(package) is None:
+        return package
+    return None
+
+
+def check_equivalence(out_dir, formats, reference, images, rtol, atol):
+    """
+    This function runs every exported file on images and compares the outputs
+    with the Keras reference. Returns True if all of them match
+    """
+    ok = True
+    for name in formats:
+        backend = load_backend(name, out_dir)
+        result = np.asarray(backend.predict(images))
+        max_abs = float(np.max(np.abs(result - reference)))
+        max_rel = float(np.max(np.abs(result - reference) / np.abs(reference)))
+        match = result.shape == reference.shape and np.allclose(
+            result, reference, rtol=rtol, atol=atol
+        )
+        ok = ok and match
+        print(
+            f"{name:>10}: max abs diff {max_abs:.2e}, max rel diff {max_rel:.2e} "
+            f"-> {'OK' if match else 'MISMATCH'}"
+        )
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export the configured SediNet model for the grain backends"
+    )
+    parser.add_argument("--out", default=predict.EXPORT_DIR)
+    parser.add_argument("--formats", nargs="+", choices=sorted(EXPORTERS))
+    parser.add_argument("--num-images", type=int, default=4)
+    parser.add_argument("--rtol", type=float, default=1e-3)
+    parser.add_argument("--atol", type=float, default=1e-3)
+    args = parser.parse_args(argv)
+
+    # check before exporting anything, so a missing package cannot stop the
+    # export halfway
+    if args.formats is None:
+        args.formats = []
+        for name in sorted(EXPORTERS):
+            package = missing_requirement(name)
+            if package is None:
+                args.formats.append(name)
+            else:
+                print(f"Skipping {name}: it needs {package}, which is not installed")
+    else:
+        for name in args.formats:
+            package = missing_requirement(name)
+            if package is not None:
+                parser.error(
+                    f"the {name} export needs {package} (pip install {package})"
+                )
+
+    os.makedirs(args.out, exist_ok=True)
+    model = serving_model()
+
+    for name in args.formats:
+        path = EXPORTERS[name](model, predict.greyscale, args.out)
+        print(f"Exported {name} to {path}")
+
+    channels = 1 if predict.greyscale == True else 3
+    rng = np.random.default_rng(0)
+    images = rng.integers(
+        0, 256, (args.num_images, IM_HEIGHT, IM_WIDTH, channels), dtype=np.uint8
+    )
+    reference = serving_fn(model, predict.greyscale)(tf.constant(images)).numpy()
+
+    if not check_equivalence(
+        args.out, args.formats, reference, images, args.rtol, args.atol
+    ):
+        print("Exported models do not match the Keras reference")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
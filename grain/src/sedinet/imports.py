@@ -9,8 +9,9 @@
 import gc, os, sys, shutil
 
 ###===================================================
-# import and set global variables from defaults.py
-from .defaults import *
+# import and set global variables from defaults.py, and the libraries
+# needed for inference
+from .inference_imports import *
 
 global IM_HEIGHT, IM_WIDTH
 
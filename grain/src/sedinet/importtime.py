@@ -0,0 +1,109 @@
+###===================================================
+## Reports where the import time of a module goes, from `python -X importtime`.
+##
+## Usage (from grain/src):
+##     python -m sedinet.importtime [--module sedinet.sedinet_models] [--top 15]
+##         [--exclude matplotlib pandas ...]
+##
+## --exclude makes the listed packages unimportable in the measured
+## interpreter, to see what the import costs in an image without them.
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+from collections import Counter
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BLOCKER = """
+import sys
+class _Excluded:
+    def find_spec(self, name, path=None, target=None):
+        if name.split(".")[0] in {excluded!r}:
+            raise ModuleNotFoundError(f"No module named {{name!r}}", name=name)
+sys.meta_path.insert(0, _Excluded())
+"""
+
+# Installed only for training; keras imports them whenever they are present
+TRAINING_ONLY = ["matplotlib", "pandas", "sklearn", "skimage", "scipy", "tqdm"]
+
+
+def measure(module, exclude=()):
+    """
+    This function imports module in a fresh interpreter with -X importtime and
+    returns its (self_us, cumulative_us, depth, name) rows
+    """
+    code = BLOCKER.format(excluded=set(exclude)) if exclude else ""
+    code += f"import {module}"
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        cwd=SRC_DIR,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{proc.stderr[-2000:]}")
+
+    rows = []
+    for line in proc.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            rows.append(
+                (
+                    int(match[1]),
+                    int(match[2]),
+                    len(match[3]) // 2,
+                    match[4],
+                )
+            )
+    return rows
+
+
+def summarize(rows):
+    """
+    This function adds up the self time of every import per top-level package
+    """
+    totals = Counter()
+    for self_us, _, _, name in rows:
+        totals[name.split(".")[0]] += self_us
+    return totals
+
+
+def report(module, top=15, exclude=()):
+    totals = summarize(measure(module, exclude))
+    total = sum(totals.values())
+
+    label = f" without {', '.join(exclude)}" if exclude else ""
+    print(f"import {module}{label}: {total / 1e6:.2f}s, {len(totals)} packages")
+    for name, us in totals.most_common(top):
+        print(f"    {name:<24} {us / 1e3:9.1f} ms  {100 * us / total:5.1f}%")
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Summarize the import time of a module by top-level package"
+    )
+    parser.add_argument("--module", default="sedinet.sedinet_models")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument(
+        "--exclude",
+        nargs="*",
+        default=None,
+        help=f"packages to make unimportable (no value: {' '.join(TRAINING_ONLY)})",
+    )
+    args = parser.parse_args(argv)
+
+    full = report(args.module, args.top)
+    if args.exclude is not None:
+        print()
+        slim = report(args.module, args.top, args.exclude or TRAINING_ONLY)
+        print(f"\nsaved {(full - slim) / 1e6:.2f}s ({100 * (full - slim) / full:.0f}%)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
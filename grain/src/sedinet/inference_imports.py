@@ -0,0 +1,27 @@
+###===================================================
+## The libraries needed to build SediNet models and predict with them.
+## imports.py adds everything training, plotting and augmentation need on
+## top of these; keep this module free of anything else, since the grain
+## service imports it at startup.
+
+import os
+
+###===================================================
+# import and set global variables from defaults.py
+from .defaults import *
+
+VALID_BATCH_SIZE = BATCH_SIZE
+
+##TF/keras
+from tensorflow.keras.layers import Input, Dense, MaxPool2D, GlobalMaxPool2D
+from tensorflow.keras.layers import Dropout, SeparableConv2D
+from tensorflow.keras.layers import BatchNormalization, concatenate, Rescaling
+from tensorflow.keras.models import Model
+
+import tensorflow.keras.backend as K
+import tensorflow as tf
+
+##OTHER
+from PIL import Image
+import numpy as np
+import joblib
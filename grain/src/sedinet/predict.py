@@ -1,4 +1,4 @@
-import json, os
+import hashlib, json, os, time
 from numpy import any as npany
 import json
 
@@ -12,6 +12,40 @@ WEIGHTS_PATH = [
 
 USE_GPU = True
 
+# largest number of tiles passed to the network in one forward call
+MAX_BATCH_SIZE = int(os.getenv("SEDINET_MAX_BATCH_SIZE", "8"))
+
+# run the ensemble as one fused graph instead of one predict call per member
+USE_FUSED_ENSEMBLE = os.getenv("SEDINET_FUSED_ENSEMBLE", "true").lower() == "true"
+
+# serve through a tf.function traced once at startup instead of Model.predict
+USE_COMPILED = os.getenv("SEDINET_COMPILED", "true").lower() == "true"
+
+# compile the inference function with XLA (jit_compile=True); meant for GPU
+# nodes, the XLA CPU separable-conv kernels are much slower than the default ones
+USE_XLA = os.getenv("SEDINET_XLA", "false").lower() == "true"
+
+# compute precision of the keras backend: float32, bfloat16 or float16.
+# The regression heads and the bias correction always run in float32
+PRECISION = os.getenv("SEDINET_PRECISION", "float32")
+
+# serve an inference-only rebuild of every ensemble member (BatchNormalization
+# folded into the next Dense layer, no Dropout, one merged output head),
+# checked against the trained model when it is loaded
+OPTIMIZE_GRAPH = os.getenv("SEDINET_OPTIMIZE_GRAPH", "true").lower() == "true"
+
+# runtime that serves predictions: "keras" builds the model from CONFIG_PATH and
+# WEIGHTS_PATH, the others load the files written by `python -m sedinet.export`
+BACKEND = os.getenv("SEDINET_BACKEND", "keras")
+EXPORT_DIR = os.getenv("SEDINET_EXPORT_DIR", f"{BASE_PATH}/export")
+
+# intra-op threads for the tflite and onnx backends (None = runtime default)
+NUM_THREADS = int(os.getenv("SEDINET_NUM_THREADS", "0")) or None
+
+# correct every ensemble member's outputs with the polynomials of its
+# _bias.pkl file before taking the median
+BIAS_CORRECTION = os.getenv("SEDINET_BIAS_CORRECTION", "true").lower() == "true"
+
 if USE_GPU == True:
     ##use the first available GPU
     os.environ["CUDA_VISIBLE_DEVICES"] = "0"  #'1'
@@ -77,9 +111,45 @@ def load_config(config_path):
 
 
 from .sedinet_models import *
+from .backends import BACKENDS, load_backend
+
+
+def cpu_supports_bfloat16():
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def set_precision(precision):
+    """
+    This function sets the keras dtype policy used for every model built after it
+    """
+    if precision == "float32":
+        tf.keras.mixed_precision.set_global_policy("float32")
+        return
+    if precision not in ("bfloat16", "float16"):
+        raise ValueError(f"Unknown SediNet precision '{precision}'")
+    if precision == "bfloat16" and not cpu_supports_bfloat16():
+        print("Warning: this CPU has no native bfloat16 support, expect it to be slow")
+    tf.keras.mixed_precision.set_global_policy(f"mixed_{precision}")
+
+
+def active_precision():
+    if BACKEND == "keras":
+        return PRECISION
+    return "int8" if BACKEND == "tflite_int8" else "float32"
+
 
 SM = None
 CS = None
+FM = None
+INFER_FN = None
+COMPILE_STATS = {}
+ENGINE = None
+BIAS = None
 
 
 def load_model(vars, greyscale, dropout, scale, weights_path):
@@ -121,6 +191,179 @@ def load_model(vars, greyscale, dropout, scale, weights_path):
             SM.load_weights(weights_path)
 
 
+def optimize_model(vars, greyscale, num_images=2, rtol=1e-4, atol=1e-4):
+    """
+    This function replaces every loaded model with its inference-only version
+    (see make_inference_sedinet) after checking that both give the same
+    outputs on random images; raises ValueError if they do not
+    """
+    global SM
+    if PRECISION != "float32":
+        # the folded weights are rounded to the compute precision
+        rtol, atol = 1e-2, 1e-2
+
+    channels = 1 if greyscale == True else 3
+    rng = np.random.default_rng(0)
+    images = rng.random((num_images, IM_HEIGHT, IM_WIDTH, channels), dtype=np.float32)
+
+    optimized = []
+    for model in SM if type(SM) == list else [SM]:
+        fast = make_inference_sedinet(model, vars)
+        reference = stack_outputs(model(images, training=False))
+        result = np.asarray(fast(images, training=False))
+        max_abs = float(np.max(np.abs(result - reference)))
+        if not np.allclose(result, reference, rtol=rtol, atol=atol):
+            raise ValueError(
+                f"Optimized {model.name} does not match the trained model "
+                f"(max abs diff {max_abs:.2e})"
+            )
+        print(f"Optimized {model.name}: max abs diff {max_abs:.2e}")
+        optimized.append(fast)
+
+    SM = optimized if type(SM) == list else optimized[0]
+
+
+def load_fused_model(greyscale):
+    """
+    This function builds the models the service runs: the fused ensemble
+    (FM) or, with SEDINET_FUSED_ENSEMBLE=false, every member on its own (SM).
+    Either way they take uint8 (N, IM_HEIGHT, IM_WIDTH, channels) pixels and
+    rescale them to [0, 1] in the graph, so every path is fed the same tiles.
+    The members SM held before are float32 [0, 1] models, as trained
+    """
+    global FM, SM
+    if USE_FUSED_ENSEMBLE:
+        FM = make_fused_sedinet_ensemble(SM if type(SM) == list else [SM], greyscale)
+    else:
+        FM = None
+        if type(SM) == list:
+            SM = [make_uint8_sedinet(s, greyscale) for s in SM]
+        else:
+            SM = make_uint8_sedinet(SM, greyscale)
+
+
+def compile_inference_fn(greyscale, jit_compile=USE_XLA, max_batch_size=MAX_BATCH_SIZE):
+    """
+    This function traces the serving model into a tf.function with a fixed
+    (None, IM_HEIGHT, IM_WIDTH, channels) signature of the model's input dtype
+    and runs it once so that kernel selection (and XLA compilation) happens
+    at startup
+    """
+    global INFER_FN, COMPILE_STATS
+    model = FM if FM is not None else SM
+    if not USE_COMPILED or type(model) == list:
+        INFER_FN = None
+        COMPILE_STATS = {}
+        return
+
+    channels = 1 if greyscale == True else 3
+    spec = tf.TensorSpec(
+        shape=(None, IM_HEIGHT, IM_WIDTH, channels), dtype=model.inputs[0].dtype
+    )
+
+    @tf.function(input_signature=[spec], jit_compile=jit_compile)
+    def infer(images):
+        outputs = model(images, training=False)
+        if isinstance(outputs, (list, tuple)):
+            outputs = tf.concat(outputs, axis=-1)
+        return outputs
+
+    start = time.perf_counter()
+    infer.get_concrete_function()
+    trace_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    infer(tf.zeros((max_batch_size, IM_HEIGHT, IM_WIDTH, channels), dtype=spec.dtype))
+    compile_s = time.perf_counter() - start
+
+    INFER_FN = infer
+    COMPILE_STATS = {
+        "jit_compile": jit_compile,
+        "batch_size": max_batch_size,
+        "trace_s": round(trace_s, 3),
+        "first_call_s": round(compile_s, 3),
+    }
+    print(f"Compiled SediNet inference function: {COMPILE_STATS}")
+
+
+def run_in_chunks(fn, images, max_batch_size=MAX_BATCH_SIZE, pad=False):
+    """
+    This function runs fn over a batch in chunks of at most max_batch_size.
+    With pad=True the last chunk is zero-padded so that the runtime only ever
+    sees one batch shape (one XLA compilation, one tflite allocation).
+    Chunks keep the dtype of images; a batch that is already one chunk is
+    passed to fn as is
+    """
+    if len(images) == max_batch_size or (len(images) < max_batch_size and not pad):
+        return np.asarray(fn(images))
+
+    results = []
+    for start in range(0, len(images), max_batch_size):
+        chunk = np.asarray(images[start : start + max_batch_size])
+        n = len(chunk)
+        if pad and n < max_batch_size:
+            chunk = np.pad(chunk, [(0, max_batch_size - n)] + [(0, 0)] * 3)
+        results.append(np.asarray(fn(chunk))[:n])
+    return np.concatenate(results, axis=0)
+
+
+def run_inference_fn(images, max_batch_size=MAX_BATCH_SIZE):
+    return run_in_chunks(
+        lambda chunk: INFER_FN(tf.constant(chunk)).numpy(),
+        images,
+        max_batch_size=max_batch_size,
+        pad=USE_XLA,
+    )
+
+
+def load_bias_coefficients(weights_path=WEIGHTS_PATH):
+    """
+    This function loads the bias-correction polynomials of every ensemble
+    member into one (members, len(vars), degree + 1) array, or returns None
+    if a member has no _bias.pkl file
+    """
+    if type(BATCH_SIZE) != list:
+        weights_path = weights_path[:1]
+
+    Z = []
+    for wp in weights_path:
+        bias_path = wp.replace(".weights.h5", "_bias.pkl")
+        if not os.path.exists(bias_path):
+            print(f"Warning: Bias file not found at {bias_path}.")
+            return None
+        Z.append([np.asarray(z, dtype=np.float64) for z in joblib.load(bias_path)])
+
+    # leading zero coefficients leave a polynomial unchanged
+    degree = max(len(z) for member in Z for z in member)
+    return np.array([[np.pad(z, (degree - len(z), 0)) for z in member] for member in Z])
+
+
+def padded_batches():
+    """
+    This function tells whether the runtime is only ever called with full
+    max_batch_size chunks (the last chunk of a batch is padded)
+    """
+    return (ENGINE is not None and ENGINE.pad_batches) or (
+        ENGINE is None and INFER_FN is not None and USE_XLA
+    )
+
+
+def batch_sizes_used(max_batch_size=MAX_BATCH_SIZE):
+    """
+    This function lists the batch sizes the runtime can be called with: only
+    max_batch_size when chunks are padded, otherwise every size up to it
+    """
+    if padded_batches():
+        return [max_batch_size]
+    return list(range(1, max_batch_size + 1))
+
+
+def load_engine(backend, export_dir):
+    global ENGINE
+    ENGINE = load_backend(backend, export_dir, num_threads=NUM_THREADS)
+    print(f"Loaded SediNet {backend} backend from {export_dir}")
+
+
 def estimate_siso_simo(
     image,
     greyscale,
@@ -130,78 +373,180 @@ def estimate_siso_simo(
     """
     This function uses a sedinet model for continuous prediction on 1 image
     """
+    tile = preprocess_image(image, greyscale)
+    return estimate_siso_simo_batch(tile[np.newaxis], scale)[0].tolist()
+
+
+def preprocess_image(image, greyscale):
+    """
+    This function resizes 1 image to the network input size and returns its
+    uint8 pixels with a channel axis; the model rescales them to [0, 1]
+    """
     im = Image.fromarray(image)
 
     if greyscale == True:
         im = im.convert("LA")
         im = im.resize((IM_HEIGHT, IM_HEIGHT))
-        im = np.array(im)[:, :, 0]
+        im = np.array(im)[:, :, :1]
     else:
         im = im.resize((IM_HEIGHT, IM_HEIGHT))
         im = np.array(im)
 
-    im = np.array(im) / 255.0
+    return im
 
-    if greyscale == True:
-        if type(SM) == list:
-            R = []
-            for s in SM:
-                R.append(s.predict(np.expand_dims(np.expand_dims(im, axis=2), axis=0)))
-            result = np.median(np.hstack(R), axis=1)
-            del R
-        else:
-            result = SM.predict(np.expand_dims(np.expand_dims(im, axis=2), axis=0))
-    else:
-        # result = SM.predict(np.expand_dims(im, axis=0))
-        if type(SM) == list:
-            R = []
-            for s in SM:
-                R.append(s.predict(np.expand_dims(im, axis=0)))
-            result = np.median(np.hstack(R), axis=1)
-            del R
-        else:
-            result = SM.predict(np.expand_dims(im, axis=0))
 
-    result = [float(r[0]) for r in result]
+def stack_outputs(outputs):
+    """
+    This function joins the per-variable model outputs into one (N, len(vars)) array
+    """
+    if not isinstance(outputs, (list, tuple)):
+        outputs = [outputs]
+    return np.concatenate([np.asarray(o).reshape(len(o), -1) for o in outputs], axis=1)
+
 
-    if scale == True:
-        result_scaled = []
-        for r, cs in zip(result, CS):
-            result_scaled.append(
-                float(cs.inverse_transform(np.array(r).reshape(1, -1))[0])
+def postprocess_members(members, bias, out=None):
+    """
+    This function applies each ensemble member's bias-correction polynomial
+    to its predictions and takes the median over members.
+    members: (N, members, len(vars)) raw predictions
+    bias: (members, len(vars), degree + 1) coefficients, or None to skip
+    out: optional (N, len(vars)) float64 array the result is written into
+    returns: (N, len(vars)) array
+    """
+    if bias is not None:
+        if members.shape[1] != len(bias):
+            raise ValueError(
+                f"Got outputs of {members.shape[1]} ensemble members for "
+                f"{len(bias)} sets of bias coefficients; exports made before "
+                f"the members were kept apart need `python -m sedinet.export`"
             )
-        del result
-        result = result_scaled
+        # Horner's scheme, for every tile, member and variable at once
+        corrected = np.zeros(members.shape, dtype=np.float64)
+        for coefficient in np.moveaxis(bias, -1, 0):
+            corrected *= members
+            corrected += coefficient
+        members = np.abs(corrected)
+    return np.median(members, axis=1, out=out)
 
-    if type(SM) == list:
-        # files = glob(os.path.dirname(weights_path[0])+os.sep+'*.pkl') #.replace('.hdf5','_bias.pkl')
-        # file = [f for f in files if '_'.join(np.asarray(BATCH_SIZE, dtype='str')) in f][0]
-        # Z = joblib.load(file)
-        # Z = []
-        # for wp in weights_path:
-        #     Z.append(joblib.load(wp.replace('.weights.h5','_bias.pkl')))
-        pass
+
+def estimate_siso_simo_batch(
+    images,
+    scale,
+    max_batch_size=MAX_BATCH_SIZE,
+    out=None,
+):
+    """
+    This function uses a sedinet model for continuous prediction on a batch of
+    uint8 images of shape (N, IM_HEIGHT, IM_WIDTH, channels) and returns
+    an (N, len(vars)) array, written into out if given. Each model is run once
+    over the whole batch, then every member's output is bias corrected before
+    the median over members.
+    """
+    if ENGINE is not None:
+        members = run_in_chunks(
+            ENGINE.predict,
+            images,
+            max_batch_size=max_batch_size,
+            pad=ENGINE.pad_batches,
+        )
+    elif INFER_FN is not None:
+        members = run_inference_fn(images, max_batch_size=max_batch_size)
+    elif FM is not None:
+        # one forward call for every member
+        members = np.asarray(FM.predict(images, batch_size=max_batch_size, verbose=0))
+    elif type(SM) == list:
+        members = np.stack(
+            [
+                stack_outputs(s.predict(images, batch_size=max_batch_size, verbose=0))
+                for s in SM
+            ],
+            axis=1,
+        )
     else:
-        bias_path = weights_path.replace(".weights.h5", "_bias.pkl")
-        if os.path.exists(bias_path):
-            Z = joblib.load(bias_path)
-
-            result_scaled = []
-            for z, r in zip(Z, result):
-                result_scaled.append(np.abs(np.polyval(z, r)))
-            del result
-            result = result_scaled
-        else:
-            print(
-                f"Warning: Bias file not found at {bias_path}. Skipping bias correction."
-            )
+        members = stack_outputs(
+            SM.predict(images, batch_size=max_batch_size, verbose=0)
+        )
 
-    return result
+    if members.ndim == 2:
+        # a single model: (N, len(vars)) -> (N, 1, len(vars))
+        members = members[:, np.newaxis]
+
+    if scale == True:
+        n, m, v = members.shape
+        flat = members.reshape(-1, v)
+        members = np.column_stack(
+            [
+                cs.inverse_transform(flat[:, k].reshape(-1, 1)).ravel()
+                for k, cs in enumerate(CS)
+            ]
+        ).reshape(n, m, v)
+
+    return postprocess_members(members, BIAS, out=out)
 
 
 vars, greyscale, dropout, scale = load_config(CONFIG_PATH)
 
-load_model(vars, greyscale, dropout, scale, WEIGHTS_PATH)
+start = time.perf_counter()
+if BACKEND == "keras":
+    set_precision(PRECISION)
+
+    load_model(vars, greyscale, dropout, scale, WEIGHTS_PATH)
+
+    if OPTIMIZE_GRAPH:
+        optimize_model(vars, greyscale)
+
+    load_fused_model(greyscale)
+
+    compile_inference_fn(greyscale)
+else:
+    load_engine(BACKEND, EXPORT_DIR)
+
+if BIAS_CORRECTION:
+    # the prebuilt artifact carries its own coefficients
+    BIAS = getattr(ENGINE, "bias", None)
+    if BIAS is None:
+        BIAS = load_bias_coefficients()
+LOAD_S = round(time.perf_counter() - start, 3)
+print(f"Loaded SediNet ({BACKEND} backend) in {LOAD_S}s")
+
+
+def model_files():
+    """
+    This function lists every file the served predictions depend on
+    """
+    if BACKEND == "keras":
+        files = [CONFIG_PATH] + WEIGHTS_PATH
+    else:
+        files = [CONFIG_PATH, os.path.join(EXPORT_DIR, BACKENDS[BACKEND][1])]
+    files += [wp.replace(".weights.h5", "_bias.pkl") for wp in WEIGHTS_PATH]
+
+    expanded = []
+    for path in files:
+        if os.path.isdir(path):
+            for root, _, names in sorted(os.walk(path)):
+                expanded += [os.path.join(root, n) for n in sorted(names)]
+        elif os.path.exists(path):
+            expanded.append(path)
+    return expanded
+
+
+def model_version():
+    """
+    This function hashes the model files and the runtime settings, so that
+    anything cached against the version is invalidated when either changes
+    """
+    digest = hashlib.sha256(
+        f"{BACKEND}:{active_precision()}:bias={BIAS is not None}"
+        f":optimized={OPTIMIZE_GRAPH}".encode()
+    )
+    for path in model_files():
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+MODEL_VERSION = model_version()
 
 
 def predict_grain_size(image):
@@ -212,3 +557,22 @@ def predict_grain_size(image):
         WEIGHTS_PATH,
     )
     return prediction
+
+
+def preprocess_tile(tile):
+    return preprocess_image(tile, greyscale)
+
+
+def predict_grain_size_batch(tiles, max_batch_size=MAX_BATCH_SIZE, out=None):
+    """
+    Predicts all tiles of an image at once.
+    tiles: (N, IM_HEIGHT, IM_WIDTH, channels) uint8 array of preprocessed tiles
+    out: optional (N, len(vars)) float64 array to write the predictions into
+    returns: (N, len(vars)) array
+    """
+    return estimate_siso_simo_batch(
+        tiles,
+        scale,
+        max_batch_size=max_batch_size,
+        out=out,
+    )
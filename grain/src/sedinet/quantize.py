@@ -0,0 +1,170 @@
+###===================================================
+## INT8 post-training quantization of the configured SediNet model.
+## Calibrates on a folder of sample sand photos, cut into tiles the way
+## the service cuts an upload, writes an integer-only
+## tflite model next to the other exports and reports how far its
+## predictions are from the float ensemble, and how much faster it is.
+##
+## usage (from /app/src):
+##   python -m sedinet.quantize --calibration-dir DIR [--mm-per-pixel MM] [--out DIR]
+##
+## serve it with SEDINET_BACKEND=tflite_int8
+
+import argparse
+import json
+import os
+import sys
+import time
+from glob import glob
+
+import numpy as np
+
+# the service's tile cutting, importable when run from /app/src
+from preprocessing import decode_settings, prepare_tiles, preprocess_image, tile_size_px
+
+from . import predict
+from .backends import TFLITE_INT8_NAME, TFLiteBackend
+from .export import serving_fn, serving_model
+from .sedinet_models import IM_HEIGHT, tf
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp")
+
+
+def load_calibration_tiles(calibration_dir, limit=None, mm_per_pixel=None):
+    """
+    This function decodes, resamples and tiles every image in calibration_dir
+    with the service's tile cutting (preprocessing.py, quality filter
+    included), so the model is calibrated on the tiles it will see.
+    mm_per_pixel is only used with physical-scale tiling. At most limit tiles
+    are returned
+    """
+    files = sorted(
+        f
+        for f in glob(os.path.join(calibration_dir, "*"))
+        if f.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    if not files:
+        raise FileNotFoundError(f"No calibration images found in {calibration_dir}")
+
+    greyscale = predict.greyscale == True
+    decoding = decode_settings(IM_HEIGHT, greyscale)
+    tile_size = tile_size_px(mm_per_pixel or 0)
+    tiles = []
+    for f in files:
+        with open(f, "rb") as fh:
+            image, scale = decoding.decode(fh.read(), mm_per_pixel)
+        img, scale = preprocess_image(image, scale, tile_size, IM_HEIGHT, greyscale)
+        tiles += prepare_tiles(img, None, scale, tile_size=tile_size)
+        if limit and len(tiles) >= limit:
+            break
+    if not tiles:
+        raise ValueError(f"No valid sand tiles in the images in {calibration_dir}")
+    return np.stack(tiles[:limit])
+
+
+def quantize_int8(model, tiles):
+    """
+    This function converts model to a tflite flatbuffer with int8 weights and
+    activations, calibrated on tiles. The model's uint8 input and float32
+    output are kept, so the service feeds it the same batches as the float
+    backends
+    """
+
+    def representative_dataset():
+        for tile in tiles:
+            yield [tile[np.newaxis]]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_output_type = tf.float32
+    return converter.convert()
+
+
+def timed(fn, tiles, max_batch_size, pad):
+    fn(tiles[:max_batch_size])
+    start = time.perf_counter()
+    result = predict.run_in_chunks(fn, tiles, max_batch_size=max_batch_size, pad=pad)
+    return result, time.perf_counter() - start
+
+
+def deviation_report(reference, quantized, float_s, int8_s):
+    """
+    This function summarises the relative deviation of each output from the
+    float ensemble and the speedup, per tile
+    """
+    rel = np.abs(quantized - reference) / np.abs(reference)
+    n = len(reference)
+    return {
+        "tiles": n,
+        "float_ms_per_tile": round(1000 * float_s / n, 2),
+        "int8_ms_per_tile": round(1000 * int8_s / n, 2),
+        "speedup": round(float_s / int8_s, 2),
+        "deviation_pct": {
+            var: {
+                "mean": round(100 * float(np.mean(rel[:, k])), 2),
+                "p95": round(100 * float(np.percentile(rel[:, k], 95)), 2),
+                "max": round(100 * float(np.max(rel[:, k])), 2),
+            }
+            for k, var in enumerate(predict.vars)
+        },
+    }
+
+
+def print_report(report):
+    print(f"calibration tiles: {report['tiles']}")
+    print(
+        f"float32: {report['float_ms_per_tile']} ms/tile, "
+        f"int8: {report['int8_ms_per_tile']} ms/tile, "
+        f"speedup x{report['speedup']}"
+    )
+    print(f"{'output':>10} {'mean %':>8} {'p95 %':>8} {'max %':>8}")
+    for var, d in report["deviation_pct"].items():
+        print(f"{var:>10} {d['mean']:>8} {d['p95']:>8} {d['max']:>8}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Quantize the configured SediNet model to int8 tflite"
+    )
+    parser.add_argument("--calibration-dir", required=True)
+    parser.add_argument("--out", default=predict.EXPORT_DIR)
+    parser.add_argument("--mm-per-pixel", type=float, default=None)
+    parser.add_argument("--max-tiles", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=predict.MAX_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.out, exist_ok=True)
+    tiles = load_calibration_tiles(
+        args.calibration_dir, args.max_tiles, args.mm_per_pixel
+    )
+    model = serving_model()
+
+    path = os.path.join(args.out, TFLITE_INT8_NAME)
+    with open(path, "wb") as f:
+        f.write(quantize_int8(model, tiles))
+    print(f"Exported int8 tflite to {path}")
+
+    fn = serving_fn(model, predict.greyscale)
+    reference, float_s = timed(
+        lambda chunk: fn(tf.constant(chunk)).numpy(), tiles, args.batch_size, False
+    )
+    backend = TFLiteBackend(path, num_threads=predict.NUM_THREADS)
+    quantized, int8_s = timed(backend.predict, tiles, args.batch_size, True)
+
+    # compare what the service returns: bias corrected, median over members
+    report = deviation_report(
+        predict.postprocess_members(reference, predict.BIAS),
+        predict.postprocess_members(quantized, predict.BIAS),
+        float_s,
+        int8_s,
+    )
+    print_report(report)
+    with open(path.replace(".tflite", "_report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,8 +5,10 @@
 ##> Release v1.3 (July 2020)
 
 ###===================================================
-# import libraries
-from .sedinet_utils import *
+# import libraries. Only what inference needs is imported here; the
+# training, plotting and augmentation helpers of sedinet_utils are loaded
+# on first use (see __getattr__ at the end of this module)
+from .inference_imports import *
 
 
 class PinballLoss(tf.keras.losses.Loss):
@@ -160,7 +162,12 @@ def make_sedinet_siso_simo(vars, greyscale, dropout):
 
     outputs = []
     for var in vars:
-        outputs.append(Dense(units=1, activation="linear", name=var + "_output")(_))
+        # heads stay float32 under a mixed precision policy
+        outputs.append(
+            Dense(units=1, activation="linear", name=var + "_output", dtype="float32")(
+                _
+            )
+        )
 
     if CONT_LOSS == "pinball":
         loss = dict(
@@ -181,6 +188,184 @@ def make_sedinet_siso_simo(vars, greyscale, dropout):
     return model
 
 
+###===================================================
+def batchnorm_affine(layer):
+    """
+    This function returns the per-channel (scale, shift) that a trained
+        BatchNormalization layer applies at inference time
+    """
+    variance = np.asarray(layer.moving_variance, dtype=np.float64)
+    scale = 1 / np.sqrt(variance + layer.epsilon)
+    if layer.scale:
+        scale = scale * np.asarray(layer.gamma, dtype=np.float64)
+    shift = -np.asarray(layer.moving_mean, dtype=np.float64) * scale
+    if layer.center:
+        shift = shift + np.asarray(layer.beta, dtype=np.float64)
+    return scale, shift
+
+
+###===================================================
+def make_inference_sedinet(model, vars):
+    """
+    This function builds an inference-only version of a trained sedinet
+        continuous model (see make_sedinet_siso_simo) that computes the same
+        outputs with fewer ops: the final BatchNormalization is folded into
+        the first Dense layer, Dropout is removed, the per-variable Dense(1)
+        heads are merged into one Dense(len(vars)) head and the model is not
+        compiled, so it holds no optimizer, loss or metric state.
+        The convolutional layers are shared with model, not copied.
+        The BatchNormalization sits after a ReLU and a max pooling, so it
+        cannot be folded into the preceding pointwise kernel; it is moved
+        past the global max pooling instead, which is exact when its scale is
+        positive for every channel (otherwise it is kept as is)
+    """
+    layers = [l for l in model.layers[1:] if not isinstance(l, Dropout)]
+    dense = [l for l in layers if isinstance(l, Dense)]
+    heads = [model.get_layer(var + "_output") for var in vars]
+    hidden = dense[0]
+    if dense[1:] != heads:
+        raise ValueError(f"{model.name} is not a sedinet continuous model")
+
+    input_layer = Input(shape=model.input_shape[1:])
+    _ = input_layer
+    scale, shift = None, None
+    for i, layer in enumerate(layers[: layers.index(hidden)]):
+        if (
+            isinstance(layer, BatchNormalization)
+            and isinstance(layers[i + 1], GlobalMaxPool2D)
+            and np.all(batchnorm_affine(layer)[0] > 0)
+        ):
+            # max(scale * x + shift) = scale * max(x) + shift for scale > 0
+            scale, shift = batchnorm_affine(layer)
+            continue
+        _ = layer(_)
+
+    kernel, bias = [np.asarray(w, dtype=np.float64) for w in hidden.get_weights()]
+    if scale is not None:
+        bias = bias + shift @ kernel
+        kernel = scale[:, np.newaxis] * kernel
+    folded = Dense(units=hidden.units, activation=hidden.activation, name=hidden.name)
+    _ = folded(_)
+    folded.set_weights([kernel, bias])
+
+    # heads stay float32 under a mixed precision policy
+    merged = Dense(
+        units=len(vars), activation="linear", name="outputs", dtype="float32"
+    )
+    outputs = merged(_)
+    merged.set_weights(
+        [
+            np.concatenate([h.get_weights()[0] for h in heads], axis=1),
+            np.concatenate([h.get_weights()[1] for h in heads]),
+        ]
+    )
+
+    return Model(inputs=input_layer, outputs=outputs, name=model.name + "_inference")
+
+
+###===================================================
+class EnsembleStack(tf.keras.layers.Layer):
+    """
+    This layer stacks the ensemble member outputs along a new members axis
+    """
+
+    def call(self, inputs):
+        return tf.stack(inputs, axis=1)
+
+
+###===================================================
+def uint8_pixels_input(greyscale):
+    """
+    This function returns the uint8 (N, IM_HEIGHT, IM_WIDTH, channels) input
+        layer the served models take, and the float32 [0, 1] pixels it is
+        rescaled to, which is what the members were trained on
+    """
+    if greyscale == True:
+        input_layer = Input(shape=(IM_HEIGHT, IM_WIDTH, 1), dtype="uint8")
+    else:
+        input_layer = Input(shape=(IM_HEIGHT, IM_WIDTH, 3), dtype="uint8")
+
+    pixels = Rescaling(1 / 255.0, name="rescale_pixels", dtype="float32")(input_layer)
+    return input_layer, pixels
+
+
+###===================================================
+def make_uint8_sedinet(model, greyscale):
+    """
+    This function wraps a trained sedinet model so that, like the fused
+        ensemble, it takes uint8 pixels and rescales them to [0, 1] in its
+        first op; its outputs are those of model
+    """
+    input_layer, pixels = uint8_pixels_input(greyscale)
+    return Model(
+        inputs=input_layer,
+        outputs=model(pixels, training=False),
+        name=model.name + "_uint8",
+    )
+
+
+###===================================================
+def make_fused_sedinet_ensemble(models, greyscale):
+    """
+    This function joins trained sedinet continuous models into one
+        inference-only model that takes uint8 pixels, rescales them to [0, 1]
+        in its first op, feeds the result to every member and returns their
+        outputs as one (N, members, len(vars)) tensor; the per-member bias
+        correction and the median over members are applied to it afterwards
+        (see postprocess_members in predict.py)
+    """
+    input_layer, pixels = uint8_pixels_input(greyscale)
+
+    member_outputs = []
+    for model in models:
+        outputs = model(pixels, training=False)
+        if isinstance(outputs, (list, tuple)):
+            outputs = (
+                concatenate(list(outputs), axis=-1) if len(outputs) > 1 else outputs[0]
+            )
+        member_outputs.append(outputs)
+
+    output = EnsembleStack(name="ensemble_members", dtype="float32")(member_outputs)
+
+    return Model(inputs=input_layer, outputs=output, name="sedinet_ensemble")
+
+
+###===================================================
+# the training, plotting and augmentation helpers defined in sedinet_utils
+_UTILS_NAMES = frozenset(
+    {
+        "exponential_decay",
+        "v_flip",
+        "warp_shift",
+        "apply_aug",
+        "get_data_generator_Nvars_siso_simo",
+        "get_data_generator_1image",
+        "plot_train_history_1var",
+        "plot_train_history_Nvar",
+        "plot_train_history_1var_mae",
+        "plot_confusion_matrix",
+        "plot_confmat",
+        "predict_test_train_cat",
+        "predict_test_train_siso_simo",
+        "tidy",
+        "get_df",
+    }
+)
+
+
+def __getattr__(name):
+    """
+    This function loads sedinet_utils the first time one of its helpers is
+    looked up on this module, so training code can keep using them from
+    here. Any other unknown name is an AttributeError, as usual
+    """
+    if name not in _UTILS_NAMES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    from . import sedinet_utils
+
+    return getattr(sedinet_utils, name)
+
+
 # ###===================================================
 # def conv_block_mbn(x, filters=32, alpha=1):
 #    """
@@ -0,0 +1,180 @@
+import mmap
+import os
+import threading
+from typing import NamedTuple
+
+import numpy as np
+
+from logger import logger
+
+SHM_DIR = "/dev/shm"
+
+# Blocks are named <prefix>-<owner pid>-<n>
+PREFIX = "grain-img"
+
+# Block sizes are rounded up to this, so that images of similar size reuse
+# the same blocks
+BLOCK_ALIGN = 1 << 20
+
+
+class ImageRef(NamedTuple):
+    """
+    What is sent to a worker instead of the pixels: the name of the
+    shared-memory block holding the image, its shape and its dtype.
+    """
+
+    name: str
+    shape: tuple[int, ...]
+    dtype: str
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def remove_stale_blocks(directory: str = SHM_DIR, prefix: str = PREFIX) -> int:
+    """
+    Unlinks the blocks left behind by owner processes that no longer exist
+    (e.g. after a crash). Blocks named after this process are removed too:
+    this is called before its pool creates any, so they were left by an
+    earlier process that had the same pid. Returns the number of blocks
+    removed.
+    """
+    removed = 0
+    for name in os.listdir(directory):
+        parts = name.split("-")
+        if not name.startswith(f"{prefix}-") or not parts[-2].isdigit():
+            continue
+        pid = int(parts[-2])
+        if pid != os.getpid() and _pid_alive(pid):
+            continue
+        try:
+            os.unlink(os.path.join(directory, name))
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+class _Block:
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size = size
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            self.buffer = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def destroy(self):
+        self.buffer.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class SharedImagePool:
+    """
+    Recycled pool of shared-memory blocks that decoded images are written
+    into, so that worker processes can read them without the pixels being
+    pickled. A block is taken per request and returned once the worker is
+    done with it; at most `max_blocks` are kept, larger demand is served by
+    one-off blocks. Blocks left behind by a crashed owner are removed when
+    the next pool starts.
+    """
+
+    def __init__(self, max_blocks: int, directory: str = SHM_DIR, prefix: str = PREFIX):
+        self.max_blocks = max_blocks
+        self.directory = directory
+        self.prefix = f"{prefix}-{os.getpid()}"
+
+        removed = remove_stale_blocks(directory, prefix)
+        if removed:
+            logger.info(f"Removed {removed} stale shared image blocks")
+
+        self._free: list[_Block] = []
+        self._in_use: dict[str, _Block] = {}
+        self._counter = 0
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def put(self, image: np.ndarray) -> ImageRef:
+        """
+        Copies the image into a free block and returns its reference.
+        """
+        block = self._acquire(image.nbytes)
+        view = np.ndarray(image.shape, dtype=image.dtype, buffer=block.buffer)
+        view[...] = image
+        return ImageRef(block.name, image.shape, image.dtype.str)
+
+    def release(self, ref: ImageRef):
+        with self._lock:
+            block = self._in_use.pop(ref.name, None)
+            if block is None:
+                return
+            if len(self._free) + len(self._in_use) < self.max_blocks:
+                self._free.append(block)
+                return
+        block.destroy()
+
+    def _acquire(self, nbytes: int) -> _Block:
+        with self._lock:
+            fits = [b for b in self._free if b.size >= nbytes]
+            if fits:
+                block = min(fits, key=lambda b: b.size)
+                self._free.remove(block)
+                self.reused += 1
+            else:
+                # Drop the largest too-small block to make room for this size
+                if (
+                    self._free
+                    and len(self._free) + len(self._in_use) >= self.max_blocks
+                ):
+                    smaller = max(self._free, key=lambda b: b.size)
+                    self._free.remove(smaller)
+                    smaller.destroy()
+                size = -(-max(nbytes, 1) // BLOCK_ALIGN) * BLOCK_ALIGN
+                path = os.path.join(self.directory, f"{self.prefix}-{self._counter}")
+                self._counter += 1
+                block = _Block(path, size)
+                self.created += 1
+            self._in_use[block.name] = block
+            return block
+
+    def close(self):
+        with self._lock:
+            blocks = self._free + list(self._in_use.values())
+            self._free = []
+            self._in_use = {}
+        for block in blocks:
+            block.destroy()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "blocks": len(self._free) + len(self._in_use),
+                "in_use": len(self._in_use),
+                "bytes": sum(b.size for b in self._free + list(self._in_use.values())),
+                "created": self.created,
+                "reused": self.reused,
+            }
+
+
+def open_image(ref: ImageRef, directory: str = SHM_DIR) -> np.ndarray:
+    """
+    Maps the image of a block read-only, without copying it.
+    The mapping stays valid until the returned array is released.
+    """
+    with open(os.path.join(directory, ref.name), "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return np.ndarray(ref.shape, dtype=np.dtype(ref.dtype), buffer=buffer)
@@ -0,0 +1,81 @@
+import math
+
+import numpy as np
+
+
+def tile_origins(length: int, tile: int, stride: int) -> list[int]:
+    """
+    Start offsets of tiles along one axis. Tiles are `stride` apart and the
+    last one is aligned to the far edge, so the whole axis is covered.
+    """
+    if length < tile:
+        return []
+
+    origins = list(range(0, length - tile + 1, stride))
+    if origins[-1] != length - tile:
+        origins.append(length - tile)
+
+    return origins
+
+
+def tile_grid(height: int, width: int, tile: int, stride: int) -> np.ndarray:
+    """
+    Top-left (y, x) corners of every tile covering the image.
+    Returns an int array of shape (num_tiles, 2).
+    """
+    ys = tile_origins(height, tile, stride)
+    xs = tile_origins(width, tile, stride)
+    if not ys or not xs:
+        return np.empty((0, 2), dtype=int)
+
+    yy, xx = np.meshgrid(ys, xs, indexing="ij")
+    return np.stack([yy.ravel(), xx.ravel()], axis=1)
+
+
+def overlaps_box(
+    origins: np.ndarray, tile: int, box: tuple[float, float, float, float]
+) -> np.ndarray:
+    """
+    Mask of the tiles that intersect box = (x0, y0, x1, y1).
+    """
+    x0, y0, x1, y1 = box
+    y, x = origins[:, 0], origins[:, 1]
+    return (x < x1) & (x + tile > x0) & (y < y1) & (y + tile > y0)
+
+
+def stratified_subset(
+    origins: np.ndarray, budget: int, rng: np.random.Generator
+) -> np.ndarray:
+    """
+    Picks at most `budget` tiles spread over the whole image: the tile
+    extent is split into a grid of about `budget` cells matching its aspect
+    ratio, one random tile is drawn from every occupied cell, and any
+    remaining budget is filled at random.
+    Returns the sorted indices of the chosen tiles.
+    """
+    n = len(origins)
+    if n <= budget:
+        return np.arange(n)
+
+    y, x = origins[:, 0], origins[:, 1]
+    span_y = max(int(y.max() - y.min()), 1)
+    span_x = max(int(x.max() - x.min()), 1)
+
+    rows = max(1, math.floor(math.sqrt(budget * span_y / span_x)))
+    cols = max(1, budget // rows)
+
+    row = np.minimum((y - y.min()) * rows // span_y, rows - 1)
+    col = np.minimum((x - x.min()) * cols // span_x, cols - 1)
+    cell = row * cols + col
+
+    # one random tile per occupied cell
+    order = rng.permutation(n)
+    _, first = np.unique(cell[order], return_index=True)
+    chosen = order[first]
+
+    if len(chosen) < budget:
+        rest = np.setdiff1d(np.arange(n), chosen)
+        extra = rng.choice(rest, size=budget - len(chosen), replace=False)
+        chosen = np.concatenate([chosen, extra])
+
+    return np.sort(chosen[:budget])
@@ -0,0 +1,418 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from functools import partial
+
+import numpy as np
+from fastapi import HTTPException, status
+
+from cache import content_key
+from logger import logger
+from models import PredictionResponse
+from shared_images import SharedImagePool, open_image
+
+# Backends that memory-map their model file read-only. Only the file is
+# shared through the page cache: XNNPACK still repacks the weights in each
+# worker process, and the other backends load a full copy in every worker
+MMAP_BACKENDS = ("tflite", "tflite_int8")
+
+# How often the dispatcher checks for worker processes that died
+LIVENESS_INTERVAL_S = 1.0
+
+# An image goes to the worker its digest maps to, whose tile cache has seen
+# it before, unless that worker has more than this many jobs in flight
+# beyond the least loaded one
+AFFINITY_SLACK = 1
+
+
+def core_sets(num_workers: int, cores: list[int]) -> list[list[int]]:
+    """
+    Splits `cores` into `num_workers` contiguous groups of near-equal size.
+    With fewer cores than workers, workers share cores round robin.
+    """
+    if not cores:
+        return [[] for _ in range(num_workers)]
+    if len(cores) < num_workers:
+        return [[cores[i % len(cores)]] for i in range(num_workers)]
+
+    size, extra = divmod(len(cores), num_workers)
+    groups = []
+    start = 0
+    for i in range(num_workers):
+        end = start + size + (i < extra)
+        groups.append(cores[start:end])
+        start = end
+    return groups
+
+
+def _worker_main(index: int, cores: list[int], jobs, results):
+    """
+    Entry point of an inference process. Pins itself to `cores`, sizes the
+    runtime thread pools to match, loads and warms up the model and serves
+    jobs from its own queue until it receives None.
+    """
+    if cores:
+        os.sched_setaffinity(0, cores)
+        threads = str(len(cores))
+        os.environ["SEDINET_NUM_THREADS"] = threads
+        os.environ["TF_NUM_INTRAOP_THREADS"] = threads
+        os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+        os.environ["OMP_NUM_THREADS"] = threads
+
+    from PIL import Image
+
+    from inference import (
+        DECODE_SETTINGS,
+        RESULT_CACHE_SETTINGS,
+        WARMUP,
+        decode_image,
+        run_inference_decoded,
+        warm_up,
+    )
+
+    warmup = warm_up() if WARMUP else None
+    results.put(
+        ("ready", index, os.getpid(), DECODE_SETTINGS, RESULT_CACHE_SETTINGS, warmup)
+    )
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+
+        job_id, digest, image, coin, mm_per_pixel, kwargs = job
+        try:
+            if isinstance(image, bytes):
+                decode = partial(decode_image, image, mm_per_pixel)
+            else:
+                # Decoded by the API process into shared memory
+                ref, scale = image
+                decode = lambda: (Image.fromarray(open_image(ref)), scale)
+            # The API process caches the results
+            response = run_inference_decoded(
+                digest, decode, coin, mm_per_pixel, cache_results=False, **kwargs
+            )
+            results.put(("done", index, job_id, response, None))
+        except Exception as e:
+            # Sent as text, since not every exception survives pickling
+            results.put(("done", index, job_id, None, f"{type(e).__name__}: {e}"))
+
+
+class _Worker:
+    def __init__(self, index: int, cores: list[int]):
+        self.index = index
+        self.cores = cores
+        self.process = None
+        self.jobs = None
+        self.pid = None
+        self.warmup = None
+        self.ready = threading.Event()
+        self.started_once = False
+        self.pending: dict[int, Future] = {}
+        self.completed = 0
+        self.restarts = 0
+
+
+class WorkerPool:
+    """
+    Runs `run_inference` in `num_workers` separate processes, each pinned to
+    its own subset of the cores. A dispatcher in the API process sends every
+    image to the worker its digest maps to, or to the ready worker with the
+    fewest jobs in flight when that one is busy or down; a reader thread
+    resolves the callers' futures and restarts workers that die, failing
+    their in-flight jobs. A job that takes longer than `job_timeout_s` is
+    answered with 504.
+    Results are cached in the API process, with the settings the workers
+    report, so a repeated image is answered before it is decoded or sent to
+    a worker.
+    With `shared_images`, images are decoded in the API process into a
+    pool of up to `max_images` shared-memory blocks and workers map them
+    instead of receiving the encoded bytes.
+    While no worker is ready, jobs are rejected with 503 and a Retry-After
+    header of `retry_after_s`.
+    """
+
+    def __init__(
+        self,
+        num_workers: int,
+        pin_cores: bool = True,
+        shared_images: bool = False,
+        max_images: int = 0,
+        retry_after_s: int = 5,
+        job_timeout_s: float | None = None,
+    ):
+        self._context = multiprocessing.get_context("spawn")
+        self._results = self._context.Queue()
+
+        cores = sorted(os.sched_getaffinity(0)) if pin_cores else []
+        self._workers = [
+            _Worker(i, group) for i, group in enumerate(core_sets(num_workers, cores))
+        ]
+
+        self._lock = threading.Lock()
+        self._job_ids = itertools.count()
+        self._closed = False
+        self._reader = None
+        self.retry_after_s = retry_after_s
+        self.job_timeout_s = job_timeout_s
+
+        self.shared_images = shared_images
+        self.max_images = max_images
+        self._images = None
+        self._decode_settings = None
+        self._result_settings = None
+        self.result_cache = None
+
+    def start(self, timeout_s: float) -> dict:
+        """
+        Starts the worker processes and waits until every one has loaded
+        and warmed up the model. Returns the warm-up timings of each worker.
+        """
+        backend = os.getenv("SEDINET_BACKEND", "keras")
+        if backend not in MMAP_BACKENDS:
+            logger.warning(
+                f"SediNet backend '{backend}' is not memory-mapped: each of the "
+                f"{len(self._workers)} worker processes loads its own copy of the "
+                f"model file. SEDINET_BACKEND=tflite shares the file through the "
+                f"page cache, though each worker still repacks the weights."
+            )
+
+        if self.shared_images:
+            self._images = SharedImagePool(self.max_images)
+
+        for worker in self._workers:
+            self._spawn(worker)
+
+        self._reader = threading.Thread(
+            target=self._read_results, name="worker-results", daemon=True
+        )
+        self._reader.start()
+
+        deadline = time.monotonic() + timeout_s
+        for worker in self._workers:
+            while not worker.ready.wait(LIVENESS_INTERVAL_S):
+                if worker.process is None:
+                    raise RuntimeError(
+                        f"Inference worker {worker.index} exited while loading the model"
+                    )
+                if time.monotonic() > deadline:
+                    raise RuntimeError(
+                        f"Inference worker {worker.index} did not start within {timeout_s}s"
+                    )
+
+        logger.info(
+            f"Started {len(self._workers)} inference workers: "
+            + ", ".join(f"pid {w.pid} on cores {w.cores}" for w in self._workers)
+        )
+        return {f"worker_{w.index}": w.warmup for w in self._workers}
+
+    def _spawn(self, worker: _Worker):
+        worker.ready.clear()
+        worker.jobs = self._context.Queue()
+        worker.process = self._context.Process(
+            target=_worker_main,
+            args=(worker.index, worker.cores, worker.jobs, self._results),
+            name=f"grain-worker-{worker.index}",
+            daemon=True,
+        )
+        worker.process.start()
+
+    def _ready_workers(self) -> list[_Worker]:
+        # A worker that died is skipped before the liveness check notices
+        return [
+            w
+            for w in self._workers
+            if w.ready.is_set() and w.process is not None and w.process.is_alive()
+        ]
+
+    def available(self) -> bool:
+        """
+        Whether a worker is ready to take a job.
+        """
+        return not self._closed and bool(self._ready_workers())
+
+    def submit(self, digest: str, image, coin, mm_per_pixel: float, **kwargs) -> Future:
+        future: Future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Inference worker pool is closed")
+
+            ready = self._ready_workers()
+            if not ready:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="No inference worker is ready, retry later",
+                    headers={"Retry-After": str(self.retry_after_s)},
+                )
+
+            least = min(ready, key=lambda w: len(w.pending))
+            home = self._workers[int(digest[:8], 16) % len(self._workers)]
+            if (
+                home in ready
+                and len(home.pending) <= len(least.pending) + AFFINITY_SLACK
+            ):
+                worker = home
+            else:
+                worker = least
+            job_id = next(self._job_ids)
+            worker.pending[job_id] = future
+            worker.jobs.put((job_id, digest, image, coin, mm_per_pixel, kwargs))
+
+        return future
+
+    def run_inference(self, image_bytes: bytes, coin, mm_per_pixel: float, **kwargs):
+        """
+        Same signature as inference.run_inference; blocks until a worker
+        has answered. The result cache is checked first, and a shared
+        image block only taken on a miss.
+        """
+        digest = content_key(image_bytes)
+        cache, key = self.result_cache, None
+        if cache is not None and cache.enabled:
+            key = self._result_settings.key(
+                digest, coin, mm_per_pixel, kwargs.get("max_tiles")
+            )
+            cached = cache.get(key)
+            if cached is not None:
+                logger.info("[*] Returning cached result.")
+                return PredictionResponse.model_validate_json(cached)
+
+        if self._images is None:
+            response = self._wait(
+                self.submit(digest, image_bytes, coin, mm_per_pixel, **kwargs)
+            )
+        else:
+            image, scale = self._decode_settings.decode(image_bytes, mm_per_pixel)
+            ref = self._images.put(np.asarray(image))
+            try:
+                response = self._wait(
+                    self.submit(digest, (ref, scale), coin, mm_per_pixel, **kwargs)
+                )
+            finally:
+                self._images.release(ref)
+
+        if key is not None:
+            cache.put(key, response.model_dump_json().encode())
+        return response
+
+    def _wait(self, future: Future):
+        try:
+            return future.result(timeout=self.job_timeout_s)
+        except TimeoutError:
+            # The answer of a hung worker, if it ever comes, is dropped
+            with self._lock:
+                for worker in self._workers:
+                    for job_id, pending in list(worker.pending.items()):
+                        if pending is future:
+                            del worker.pending[job_id]
+                            logger.error(
+                                f"Inference worker {worker.index} did not answer "
+                                f"within {self.job_timeout_s}s"
+                            )
+            raise HTTPException(
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                detail=f"Inference did not finish within {self.job_timeout_s}s",
+            )
+
+    def _read_results(self):
+        last_check = time.monotonic()
+        while not self._closed:
+            try:
+                message = self._results.get(timeout=LIVENESS_INTERVAL_S)
+            except queue.Empty:
+                message = None
+
+            if message is not None:
+                self._handle(message)
+
+            if time.monotonic() - last_check >= LIVENESS_INTERVAL_S:
+                self._check_workers()
+                last_check = time.monotonic()
+
+    def _handle(self, message: tuple):
+        kind, index, *payload = message
+        worker = self._workers[index]
+
+        if kind == "ready":
+            worker.pid, self._decode_settings, result_settings, worker.warmup = payload
+            if self.result_cache is None:
+                self._result_settings = result_settings
+                self.result_cache = result_settings.new_cache()
+            worker.started_once = True
+            worker.ready.set()
+            return
+
+        job_id, response, error = payload
+        with self._lock:
+            future = worker.pending.pop(job_id, None)
+            worker.completed += 1
+        if future is None:
+            return
+        if error is None:
+            future.set_result(response)
+        else:
+            future.set_exception(RuntimeError(error))
+
+    def _check_workers(self):
+        for worker in self._workers:
+            if self._closed or worker.process is None or worker.process.is_alive():
+                continue
+
+            with self._lock:
+                pending = worker.pending
+                worker.pending = {}
+                worker.ready.clear()
+
+            logger.error(
+                f"Inference worker {worker.index} (pid {worker.process.pid}) exited "
+                f"with code {worker.process.exitcode}, failing {len(pending)} jobs"
+            )
+            for future in pending.values():
+                future.set_exception(RuntimeError("Inference worker crashed"))
+
+            # A worker that never loaded the model would only crash again
+            if worker.started_once:
+                worker.restarts += 1
+                self._spawn(worker)
+            else:
+                worker.process = None
+
+    def close(self, timeout_s: float = 10.0):
+        with self._lock:
+            self._closed = True
+        processes = [w.process for w in self._workers if w.process is not None]
+        for worker in self._workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.jobs.put(None)
+        for process in processes:
+            process.join(timeout_s)
+            if process.is_alive():
+                process.terminate()
+        if self._images is not None:
+            self._images.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": [
+                    {
+                        "index": w.index,
+                        "pid": w.pid,
+                        "cores": w.cores,
+                        "ready": w.ready.is_set(),
+                        "warmup": w.warmup,
+                        "in_flight": len(w.pending),
+                        "completed": w.completed,
+                        "restarts": w.restarts,
+                    }
+                    for w in self._workers
+                ],
+                "result_cache": (
+                    self.result_cache.stats() if self.result_cache else None
+                ),
+                "shared_images": self._images.stats() if self._images else None,
+            }